@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# scaling benchmark: generate C sources, compile them with -g and time
+# parse_file, explain and gen_decl on the result
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dwarf2dtrace
+from dwarf2dtrace import TypeDG, Emitter, Node
+
+PHASES = ("parse_file", "explain", "gen_decl")
+
+
+def gen_unit(cu: int, structs: int, depth: int, cyclic: bool,
+             enum_size: int) -> str:
+    lines = [f"/* generated unit {cu} */",
+             "#include <stddef.h>",
+             # shared across units, so duplicates must collapse by name
+             "struct shared_list_node { struct shared_list_node *next_node;"
+             " void *payload_ptr; };",
+             f"enum bench_enum_{cu} {{"]
+    lines += [f"\tBENCH_ENUM_{cu}_VALUE_{i} = {i}," for i in range(enum_size)]
+    lines.append("};")
+    for s in range(structs):
+        prefix = f"bench_{cu}_{s}"
+        if cyclic:
+            lines.append(f"struct {prefix}_level_0;")
+        for d in range(depth, -1, -1):
+            fields = [f"long counter_field_{d};",
+                      f"unsigned flag_bits_{d}:3;",
+                      f"char label_array_{d}[{16 + d}];",
+                      f"enum bench_enum_{cu} state_field_{d};",
+                      "struct shared_list_node list_link;"]
+            if d < depth:
+                fields.append(f"struct {prefix}_level_{d + 1} nested_{d};")
+            if cyclic:
+                fields.append(f"struct {prefix}_level_0 *back_ptr_{d};")
+            lines.append(f"struct {prefix}_level_{d} {{ "
+                         + " ".join(fields) + " };")
+        lines.append(f"typedef struct {prefix}_level_0 {prefix}_t;")
+        lines.append(f"{prefix}_t {prefix}_instance;")
+    lines.append(f"int bench_unit_{cu}(void) {{ return 0; }}")
+    return "\n".join(lines) + "\n"
+
+
+def build(workdir: str, args) -> str:
+    sources = []
+    for cu in range(args.cus):
+        path = os.path.join(workdir, f"unit{cu}.c")
+        with open(path, "w") as f:
+            f.write(gen_unit(cu, args.structs, args.depth, args.cyclic,
+                             args.enum_size))
+        sources.append(path)
+    path = os.path.join(workdir, "main.c")
+    with open(path, "w") as f:
+        f.write("int main(void) { return 0; }\n")
+    sources.append(path)
+    binary = os.path.join(workdir, "bench.elf")
+    subprocess.run([args.cc, "-g", *args.cflags.split(), "-o", binary,
+                    *sources], check=True)
+    return binary
+
+
+def peak_rss() -> int:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(binary: str) -> dict:
+    results = {}
+    def phase(name, fn):
+        start = time.perf_counter()
+        size = fn()
+        results[name] = {"seconds": time.perf_counter() - start,
+                         "peak_rss_kb": peak_rss(), "output": size}
+    dg = TypeDG()
+    dg.out = Emitter()
+    def parse():
+        with open(binary, "rb") as f:
+            dg.parse_file(f)
+        return len(dg.offset_to_node)
+    phase("parse_file", parse)
+    def non_anon(node: Node):
+        return not (node.name is None)
+    def explain():
+        dg.explain({}, non_anon)
+        return len(dg.out.getvalue())
+    phase("explain", explain)
+    def gen_decl():
+        dg.decl_cache.clear()
+        size = 0
+        for node in dg.offset_to_node.values():
+            if not (node.tag in dg.TAGS_for_types
+                    or node.tag in dg.TAGS_for_qualifiers):
+                continue
+            try:
+                size += len(dg.gen_decl(node, "bench_field"))
+            except dwarf2dtrace.ParseError:
+                pass
+        return size
+    phase("gen_decl", gen_decl)
+    return results
+
+
+def check(results: dict, baseline: dict, threshold: float) -> list:
+    slower = []
+    for name in PHASES:
+        before = baseline.get(name, {}).get("seconds")
+        after = results[name]["seconds"]
+        if before and after > before * threshold:
+            slower.append(f"{name}: {before:.3f}s -> {after:.3f}s"
+                          f" ({after / before:.2f}x > {threshold:.2f}x)")
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="measure how dwarf2dtrace scales on generated DWARF")
+    parser.add_argument("--cus", type=int, default=8,
+                        help="number of compilation units")
+    parser.add_argument("--structs", type=int, default=20,
+                        help="struct chains per CU")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="nesting depth of each struct chain")
+    parser.add_argument("--cyclic", action="store_true",
+                        help="add pointers back to the head of each chain")
+    parser.add_argument("--enum-size", type=int,
+                        default=TypeDG.CTF_MAX_VLEN - 1,
+                        help="enumerators per CU")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="keep the fastest of N runs per phase")
+    parser.add_argument("--cc", default=os.environ.get("CC", "cc"))
+    # DWARF 5 forms such as implicit_const are not handled yet and would
+    # leave most of the fixture unparsed
+    parser.add_argument("--cflags", default="-gdwarf-4",
+                        help="extra compiler flags (default: %(default)s)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail if a phase is slower than in FILE")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="allowed slowdown factor against --baseline")
+    parser.add_argument("--keep", metavar="DIR",
+                        help="build in DIR and keep the fixture")
+    args = parser.parse_args()
+    workdir = args.keep or tempfile.mkdtemp(prefix="d2d-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        binary = build(workdir, args)
+        elf_bytes = os.path.getsize(binary)
+        results = None
+        for _ in range(args.repeat):
+            run = measure(binary)
+            if results is None:
+                results = run
+                continue
+            for name in PHASES:
+                if run[name]["seconds"] < results[name]["seconds"]:
+                    results[name] = run[name]
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+    report = {"params": {"cus": args.cus, "structs": args.structs,
+                         "depth": args.depth, "cyclic": args.cyclic,
+                         "enum_size": args.enum_size},
+              "elf_bytes": elf_bytes,
+              "phases": results}
+    for name in PHASES:
+        r = results[name]
+        print(f"{name:12s} {r['seconds']:9.3f}s {r['peak_rss_kb']:10d}KB"
+              f" {r['output']:12d}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print("bench: baseline was taken with different parameters",
+                  file=sys.stderr)
+            sys.exit(2)
+        slower = check(results, baseline["phases"], args.threshold)
+        for line in slower:
+            print(f"bench: regression in {line}", file=sys.stderr)
+        if slower:
+            sys.exit(1)
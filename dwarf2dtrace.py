@@ -3,7 +3,14 @@
 from typing import Optional, Dict, Set, Callable, Iterable
 import re
 import sys
+import os
+import contextlib
 import dataclasses
+import struct
+import array
+import mmap
+import bisect
+import collections.abc
 
 ENCODING = 'utf-8'
 class ParseError(Exception):
@@ -11,6 +18,10 @@ class ParseError(Exception):
 
 @dataclasses.dataclass
 class Node:
+    # one per DIE and kept for the whole run, hence no __dict__
+    __slots__ = ("tag", "offset", "name", "nickname", "type_goff", "is_decl",
+                 "decl_file", "decl_line", "data_member_location",
+                 "byte_size", "bit_size", "bit_offset", "deps", "quantity")
     tag: str
     offset: int
     name: str
@@ -33,6 +44,288 @@ class Node:
             return f"{decl_file}:{self.decl_line}"
         return f"{decl_file}"
 
+class NodeStore(collections.abc.MutableMapping):
+    # offset_to_node kept as typed columns instead of one object per DIE
+    # (--compact-nodes); Node instances are only built as views on lookup,
+    # and the most recently built ones are kept since track() asks for the
+    # same nodes over and over. views are shared and must not be modified.
+    # this trades speed for memory and pays off only on very large graphs
+    INT_FIELDS = {"offset": 'q', "type_goff": 'q', "decl_line": 'i',
+                  "data_member_location": 'i', "byte_size": 'i',
+                  "bit_size": 'i', "bit_offset": 'i', "quantity": 'q'}
+    STR_FIELDS = ("tag", "name", "nickname", "decl_file")
+    # the two lowest values of a column mean None and "see self.extra"
+    # (huge ints, location blocks)
+    LIMITS = {'i': (-(1 << 31), 1 << 31), 'q': (-(1 << 63), 1 << 63)}
+    VIEW_CACHE_SIZE = 4096
+
+    def __init__(self):
+        for field, typecode in self.INT_FIELDS.items():
+            setattr(self, field, array.array(typecode))
+        for field in self.STR_FIELDS:
+            setattr(self, field, array.array('i'))
+        self.is_decl = bytearray()
+        self.alive = bytearray()
+        self.deps_start = array.array('q')
+        self.deps_len = array.array('i')
+        self.deps_pool = array.array('q')
+        self.strings = []
+        self.string_ids = {}
+        self.extra = {}
+        self.index = None # built only when offsets arrive out of order
+        self.count = 0
+        self.views = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["string_ids"]
+        del state["views"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.string_ids = {s: i for i, s in enumerate(self.strings)}
+        self.views = {}
+
+    def intern(self, s: Optional[str]) -> int:
+        if s is None:
+            return -1
+        sid = self.string_ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(s)
+            self.string_ids[s] = sid
+        return sid
+
+    def find(self, goff: int) -> Optional[int]:
+        if self.index is None:
+            row = bisect.bisect_left(self.offset, goff)
+            if row < len(self.offset) and self.offset[row] == goff:
+                return row if self.alive[row] else None
+            return None
+        return self.index.get(goff)
+
+    def put(self, row: int, node: Node):
+        self.views.pop(row, None)
+        for field, typecode in self.INT_FIELDS.items():
+            value = getattr(node, field)
+            none, limit = self.LIMITS[typecode]
+            if value is None:
+                value = none
+            elif type(value) is not int or not none + 1 < value < limit:
+                self.extra[(row, field)] = value
+                value = none + 1
+            else:
+                self.extra.pop((row, field), None)
+            getattr(self, field)[row] = value
+        for field in self.STR_FIELDS:
+            getattr(self, field)[row] = self.intern(getattr(node, field))
+        self.is_decl[row] = bool(node.is_decl)
+        if node.deps is None:
+            self.deps_len[row] = -1
+        else:
+            self.deps_start[row] = len(self.deps_pool)
+            self.deps_len[row] = len(node.deps)
+            self.deps_pool.extend(node.deps)
+
+    def __setitem__(self, goff: int, node: Node):
+        row = self.find(goff)
+        if row is None:
+            row = len(self.offset)
+            if self.index is None and row and self.offset[-1] >= goff:
+                self.index = {self.offset[i]: i for i in range(row)
+                              if self.alive[i]}
+            for field in (*self.INT_FIELDS, *self.STR_FIELDS):
+                getattr(self, field).append(0)
+            self.is_decl.append(0)
+            self.alive.append(1)
+            self.deps_start.append(0)
+            self.deps_len.append(0)
+            if not self.index is None:
+                self.index[goff] = row
+            self.count += 1
+        self.put(row, node)
+        self.offset[row] = goff
+
+    def __getitem__(self, goff: int) -> Node:
+        row = self.find(goff)
+        if row is None:
+            raise KeyError(goff)
+        return self.view(row)
+
+    def view(self, row: int) -> Node:
+        node = self.views.get(row)
+        if node is not None:
+            return node
+        node = self.build_view(row)
+        if len(self.views) >= self.VIEW_CACHE_SIZE:
+            # drop the oldest half; dicts keep insertion order
+            for stale in list(self.views)[:self.VIEW_CACHE_SIZE // 2]:
+                del self.views[stale]
+        self.views[row] = node
+        return node
+
+    def build_view(self, row: int) -> Node:
+        values = {}
+        for field, typecode in self.INT_FIELDS.items():
+            value = getattr(self, field)[row]
+            none = self.LIMITS[typecode][0]
+            if value == none:
+                value = None
+            elif value == none + 1:
+                value = self.extra[(row, field)]
+            values[field] = value
+        for field in self.STR_FIELDS:
+            sid = getattr(self, field)[row]
+            values[field] = None if sid < 0 else self.strings[sid]
+        length = self.deps_len[row]
+        if length < 0:
+            deps = None
+        else:
+            start = self.deps_start[row]
+            deps = tuple(self.deps_pool[start:start + length])
+        return Node(is_decl=bool(self.is_decl[row]), deps=deps, **values)
+
+    def __delitem__(self, goff: int):
+        row = self.find(goff)
+        if row is None:
+            raise KeyError(goff)
+        self.alive[row] = 0
+        self.views.pop(row, None)
+        if not self.index is None:
+            del self.index[goff]
+        for field in self.INT_FIELDS:
+            self.extra.pop((row, field), None)
+        self.count -= 1
+
+    def __contains__(self, goff) -> bool:
+        return self.find(goff) is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        offset = self.offset
+        alive = self.alive
+        for row in range(len(offset)):
+            if alive[row]:
+                yield offset[row]
+
+    def nodes(self):
+        # a full scan would only churn the view cache
+        alive = self.alive
+        views = self.views
+        for row in range(len(self.offset)):
+            if alive[row]:
+                node = views.get(row)
+                yield node if node is not None else self.build_view(row)
+
+    def values(self):
+        return self.nodes()
+
+    def items(self):
+        return ((node.offset, node) for node in self.nodes())
+
+    def nbytes(self) -> int:
+        columns = [getattr(self, field)
+                   for field in (*self.INT_FIELDS, *self.STR_FIELDS)]
+        columns += [self.is_decl, self.alive, self.deps_start,
+                    self.deps_len, self.deps_pool]
+        total = sum(len(column) * column.itemsize
+                    if isinstance(column, array.array) else len(column)
+                    for column in columns)
+        total += sum(sys.getsizeof(s) for s in self.strings)
+        total += sys.getsizeof(self.strings) + sys.getsizeof(self.string_ids)
+        total += sys.getsizeof(self.extra) + sum(
+            sys.getsizeof(value) for value in self.extra.values())
+        total += sys.getsizeof(self.views) + sum(
+            sys.getsizeof(node) for node in self.views.values())
+        if self.index is not None:
+            total += sys.getsizeof(self.index)
+        return total
+
+class Emitter:
+    # collects output and passes it on to the sink in large chunks;
+    # without a sink, everything is kept for getvalue(). the explain
+    # methods flush when they are done
+    def __init__(self, sink = None, chunk_size: int = 1 << 20):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.sink is not None and self.size >= self.chunk_size:
+            self.flush()
+
+    def print(self, *args, sep: str = " ", end: str = "\n"):
+        self.write(sep.join(map(str, args)) + end)
+
+    def flush(self):
+        if self.sink is None:
+            return
+        self.sink.write("".join(self.parts))
+        self.sink.flush()
+        self.parts.clear()
+        self.size = 0
+
+    def getvalue(self) -> str:
+        return "".join(self.parts)
+
+class Stats:
+    # counters and phase timings; TypeDG.stats stays None unless asked
+    # for, so a normal run only pays for the 'is None' checks
+    def __init__(self):
+        self.timings = collections.Counter()
+        self.dies = collections.Counter()
+        self.cus = 0
+        self.cus_skipped = collections.Counter()
+        self.errors = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        import time
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def error(self, e: Exception):
+        # one bucket per message with offsets and numbers taken out
+        self.errors[re.sub(r"\b(0x[0-9a-fA-F]+|\d+)\b", "N", str(e))] += 1
+
+    def merge(self, other: "Stats"):
+        self.timings.update(other.timings)
+        self.dies.update(other.dies)
+        self.cus += other.cus
+        self.cus_skipped.update(other.cus_skipped)
+        self.errors.update(other.errors)
+
+    def report(self, dg: "TypeDG" = None) -> dict:
+        report = {
+            "seconds": {k: round(v, 6) for k, v in self.timings.items()},
+            "cus": self.cus,
+            "cus_skipped": dict(self.cus_skipped),
+            "dies": dict(self.dies.most_common()),
+            "errors": dict(self.errors.most_common()),
+        }
+        if dg is not None:
+            store = dg.offset_to_node
+            report["nodes"] = len(store)
+            if isinstance(store, NodeStore):
+                report["node_bytes"] = store.nbytes()
+        try:
+            import resource
+        except ImportError:
+            return report
+        # kilobytes on Linux, bytes on macOS
+        report["max_rss"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        return report
+
 class TypeDG:
     TAGS_for_types = {
         "DW_TAG_array_type": None,
@@ -49,6 +342,26 @@ class TypeDG:
         "DW_TAG_restrict_type": "restrict",
         "DW_TAG_atomic_type": "_Atomic", # C11
     }
+    # with pruning, subtrees nothing in the type graph refers to are
+    # skipped, and blocks are only searched for types declared inside
+    TAGS_pruned = {
+        "DW_TAG_variable",
+        "DW_TAG_label",
+        "DW_TAG_inlined_subroutine",
+        "DW_TAG_call_site",
+        "DW_TAG_call_site_parameter",
+        "DW_TAG_GNU_call_site",
+        "DW_TAG_GNU_call_site_parameter",
+        "DW_TAG_dwarf_procedure",
+        "DW_TAG_imported_declaration",
+        "DW_TAG_imported_module",
+        "DW_TAG_imported_unit",
+    }
+    TAGS_searched = {
+        "DW_TAG_lexical_block",
+        "DW_TAG_try_block",
+        "DW_TAG_catch_block",
+    }
     badchars = re.compile(".*[^A-Za-z0-9_ ]")
     VERBOSE = 0
     CTF_MAX_VLEN = 1023
@@ -60,138 +373,807 @@ class TypeDG:
 
     def __init__(self):
         self.offset_to_node = {}
+        self.compact = False # offset_to_node as a NodeStore (slower)
+        self.dwinfo = None # set when nodes are loaded on demand
+        self.file_tables = {}
+        self.faulted = set() # offsets get_node() must not load (again)
+        self.faulted_units = {} # cu_offset -> CU it loaded DIEs from
+        self.out = Emitter(sys.stdout)
+        self.stats = None
+        self.native_decoder = False # FastDIEReader instead of elftools DIEs
+        self.prune = False
+        self.btf = None # True/False forces BTF/DWARF, None takes .BTF if any
+        self.decl_cache = {}
+        self.hash_cache = {}
 
-    def parse_file(self, f, cu_filter = None):
-        from elftools.dwarf import constants
+    def new_store(self, nodes: Dict[int, Node] = None) -> Dict[int, Node]:
+        store = NodeStore() if self.compact else {}
+        if nodes:
+            store.update(nodes)
+        return store
+
+    def phase(self, name: str):
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.phase(name)
+
+    def open_dwarf(self, f):
         import elftools.elf.elffile
-        efile = elftools.elf.elffile.ELFFile(f)
-        dwinfo = efile.get_dwarf_info(relocate_dwarf_sections=False)
-        def register_die(die, file_table):
-            def build_node(die):
-                def get_die_attr(die, attrname, default = None):
-                    attr = die.attributes.get(attrname)
-                    if attr is None:
-                        return default
-                    if attr.form in {"DW_FORM_ref_addr",
-                                     "DW_FORM_data1",
-                                     "DW_FORM_data2",
-                                     "DW_FORM_data4",
-                                     "DW_FORM_data8",
-                                     "DW_FORM_sdata",
-                                     "DW_FORM_udata",}:
-                        return attr.value
-                    if attr.form in {"DW_FORM_ref1",
-                                     "DW_FORM_ref2",
-                                     "DW_FORM_ref4",
-                                     "DW_FORM_ref8",
-                                     "DW_FORM_ref_udata",}:
-                        return attr.value + die.cu.cu_offset # CU-relative
-                    if attr.form in {"DW_FORM_strp",}:
-                        return attr.value.decode(ENCODING)
-                    raise ParseError(f"cannot handle {die.tag} {attr.form} yet")
-                name = get_die_attr(die, "DW_AT_name")
-                if name and self.is_invalid_name(name):
-                    name = None
-                def gen_nickname(die, name):
-                    if name:
-                        return name
-                    keyword = self.TAGS_for_types.get(die.tag)
-                    if keyword is None:
-                        return None
-                    return f"anon_{keyword}__GOFF0x{die.offset:x}"
-                def get_decl_file(die):
-                    decl_file = get_die_attr(die, 'DW_AT_decl_file')
-                    if decl_file is None:
-                        return None
-                    return file_table[decl_file]
-                def get_deps(die):
-                    def gather(die, tag):
-                        return tuple(child.offset for child in die.iter_children()
-                                     if child.tag == tag)
-                    if die.tag in ("DW_TAG_structure_type",
-                                   "DW_TAG_class_type",
-                                   "DW_TAG_union_type"):
-                        return gather(die, "DW_TAG_member")
-                    if die.tag in ("DW_TAG_subprogram",
-                                   "DW_TAG_subroutine_type"):
-                        return tuple(child.offset for child in die.iter_children()
-                                     if child.tag == "DW_TAG_formal_parameter")
-                    if die.tag == "DW_TAG_enumeration_type":
-                        return tuple(child.offset for child in die.iter_children()
-                                     if child.tag == "DW_TAG_enumerator")
-                    return None
-                def get_quantity(die):
-                    if die.tag == "DW_TAG_array_type":
-                        for child in die.iter_children():
-                            if child.tag != "DW_TAG_subrange_type":
-                                continue
-                            return get_die_attr(child, "DW_AT_count")
-                    if die.tag == "DW_TAG_enumerator":
-                        return get_die_attr(die, "DW_AT_const_value")
-                    return None
-                def get_memory_location(die):
-                    data_member_location = None
-                    if die.tag == "DW_TAG_member":
-                        if "DW_AT_data_member_location" in die.attributes:
-                            return die.attributes["DW_AT_data_member_location"].value
-                        elif  "DW_AT_bit_offset" in die.attributes:
-                            return die.attributes["DW_AT_bit_offset"].value
-                    return None
-                return Node(
-                    tag = sys.intern(die.tag),
-                    offset = die.offset,
-                    name = name,
-                    nickname = gen_nickname(die, name),
-                    type_goff = get_die_attr(die, "DW_AT_type"),
-                    is_decl = ("DW_AT_declaration" in die.attributes),
-                    decl_file = get_decl_file(die),
-                    decl_line = get_die_attr(die, 'DW_AT_decl_line'),
-                    byte_size =  get_die_attr(die, 'DW_AT_byte_size'),
-                    data_member_location = get_memory_location(die),
-                    bit_size = get_die_attr(die, 'DW_AT_bit_size'),
-                    bit_offset = get_die_attr(die, 'DW_AT_bit_offset'),
-                    deps = get_deps(die),
-                    quantity = get_quantity(die),
-                )
-            try:
-                node = build_node(die)
-            except ParseError as e:
-                print(f"/* ignored {die.tag} at {die.offset}: {str(e)} */")
-                return
-            self.offset_to_node[node.offset] = node
-            if not (die.tag in self.TAGS_for_types):
-                return
-            if self.VERBOSE > 1 and node.name:
-                print(f"/* '{node.name}' is {node.tag}"
-                      f" GOFF0x{node.offset:x},"
-                      f" {node.src_location()} */")
+        with self.phase("elf_open"):
+            efile = elftools.elf.elffile.ELFFile(f)
+            return efile.get_dwarf_info(relocate_dwarf_sections=False)
 
+    def parse_file(self, f, cu_filter = None, jobs: int = 1,
+                   cu_offsets: Iterable[int] = None):
+        if self.load_btf(f):
+            return
+        dwinfo = self.open_dwarf(f)
+        if jobs > 1 and cu_offsets is None:
+            self.parse_parallel(f.name, dwinfo, cu_filter, jobs)
+            return
+        if cu_offsets is None:
+            CUs = dwinfo.iter_CUs()
+        else:
+            CUs = (dwinfo.get_CU_at(cu_offset) for cu_offset in cu_offsets)
+        self.parse_units(dwinfo, CUs, cu_filter)
+
+    def parse_units(self, dwinfo, CUs, cu_filter = None,
+                    on_unit: Callable[[object], None] = None):
         def walk(die, file_table):
-            register_die(die, file_table)
+            self.register_die(die, file_table)
             for child in die.iter_children():
                 walk(child, file_table)
-        for CU in dwinfo.iter_CUs():
+        def walk_pruned(die, file_table):
+            if die.tag in self.TAGS_pruned:
+                return # elftools jumps over it by DW_AT_sibling
+            if not die.tag in self.TAGS_searched:
+                self.register_die(die, file_table)
+            for child in die.iter_children():
+                walk_pruned(child, file_table)
+        if self.prune:
+            walk = walk_pruned
+        stats = self.stats
+        reader = None
+        if self.native_decoder:
+            reader = FastDIEReader(dwinfo,
+                                   self.TAGS_pruned if self.prune else ())
+        for CU in CUs:
             top = CU.get_top_DIE()
+            if stats is not None:
+                stats.cus += 1
             if cu_filter and not cu_filter(top.get_full_path()):
+                if stats is not None:
+                    stats.cus_skipped["filtered"] += 1
                 continue
             if self.VERBOSE > 0:
-                print(f"\n/** CU GOFF0x{CU.cu_offset:x} '{top.get_full_path()}' **/")
-            if not top.attributes['DW_AT_language'].value in {
-                    constants.DW_LANG_C,
-                    constants.DW_LANG_C89,
-                    constants.DW_LANG_C99,
-                    constants.DW_LANG_C11 if 'DW_LANG_C11' in dir(constants) else 0x1d,
-                    # constants.DW_LANG_C_plus_plus,
-                    # constants.DW_LANG_C_plus_plus_03,
-                    # constants.DW_LANG_C_plus_plus_11,
-                    # constants.DW_LANG_C_plus_plus_14,
-            }:
+                self.out.print(f"\n/** CU GOFF0x{CU.cu_offset:x} '{top.get_full_path()}' **/")
+            if not self.is_c_unit(top):
+                if stats is not None:
+                    stats.cus_skipped[self.language_of(top)] += 1
                 continue
+            file_table = self.get_file_table(CU)
+            with self.phase("cu_walk"):
+                if reader is not None:
+                    top = reader.read_unit(CU)
+                walk(top, file_table)
+            if on_unit is not None:
+                on_unit(CU)
+            self.drop_die_caches(dwinfo, [CU])
+
+    @staticmethod
+    def drop_die_caches(dwinfo, CUs):
+        # elftools keeps every DIE and line program it has parsed for as
+        # long as dwinfo lives; the nodes are all that is needed of them
+        caches = [getattr(dwinfo, "_linetable_cache", None)]
+        for CU in CUs:
+            caches += [getattr(CU, "_dielist", None),
+                       getattr(CU, "_diemap", None)]
+        for cache in caches:
+            if cache is not None:
+                cache.clear()
+
+    def is_c_unit(self, top) -> bool:
+        from elftools.dwarf import constants
+        return top.attributes['DW_AT_language'].value in {
+            constants.DW_LANG_C,
+            constants.DW_LANG_C89,
+            constants.DW_LANG_C99,
+            constants.DW_LANG_C11 if 'DW_LANG_C11' in dir(constants) else 0x1d,
+            # constants.DW_LANG_C_plus_plus,
+            # constants.DW_LANG_C_plus_plus_03,
+            # constants.DW_LANG_C_plus_plus_11,
+            # constants.DW_LANG_C_plus_plus_14,
+        }
+
+    def language_of(self, top) -> str:
+        from elftools.dwarf import enums
+        attr = top.attributes.get('DW_AT_language')
+        if attr is None:
+            return "unknown"
+        for name, value in enums.ENUM_DW_LANG.items():
+            if value == attr.value:
+                return name
+        return f"0x{attr.value:x}"
+
+    def get_file_table(self, CU):
+        with self.phase("line_programs"):
             line_program = CU.dwarfinfo.line_program_for_CU(CU)
-            # no need to pad [None] for DWARFv5 or later?
-            file_table = [None] + [sys.intern(fe.name.decode(ENCODING))
-                                   for fe in line_program['file_entry']]
-            walk(top, file_table)
+        # files are named as in the line table: relative to the directory
+        # of the compilation (index 0, the first entry from DWARF 5 on) or
+        # joined with their include directory, so shard_of() can group
+        # them by directory
+        dirs = [None] + list(line_program['include_directory'])
+        if line_program.header.version >= 5:
+            dirs[:2] = [None]
+        def path(fe):
+            name = fe.name.decode(ENCODING)
+            index = fe.dir_index
+            if index < len(dirs) and dirs[index] is not None:
+                name = os.path.join(dirs[index].decode(ENCODING), name)
+            return sys.intern(name)
+        # no need to pad [None] for DWARFv5 or later?
+        return [None] + [path(fe) for fe in line_program['file_entry']]
+
+    # BTF kinds (linux/btf.h) as the DIE tags build_node() would produce;
+    # DATASEC and DECL_TAG carry no types and TYPE_TAG is looked through
+    BTF_TAGS = {
+        1: "DW_TAG_base_type", # INT
+        2: "DW_TAG_pointer_type",
+        3: "DW_TAG_array_type",
+        4: "DW_TAG_structure_type",
+        5: "DW_TAG_union_type",
+        6: "DW_TAG_enumeration_type",
+        7: "DW_TAG_structure_type", # FWD, a union if kind_flag
+        8: "DW_TAG_typedef",
+        9: "DW_TAG_volatile_type",
+        10: "DW_TAG_const_type",
+        11: "DW_TAG_restrict_type",
+        12: "DW_TAG_subprogram", # FUNC
+        13: "DW_TAG_subroutine_type", # FUNC_PROTO
+        14: "DW_TAG_variable", # VAR
+        16: "DW_TAG_base_type", # FLOAT
+        19: "DW_TAG_enumeration_type", # ENUM64
+    }
+    BTF_TYPE_TAG = 18
+    # bytes following the 12-byte btf_type: fixed, and per vlen item
+    BTF_EXTRA = {1: (4, 0), 3: (12, 0), 4: (0, 12), 5: (0, 12), 6: (0, 8),
+                 13: (0, 8), 14: (4, 0), 15: (0, 12), 17: (4, 0),
+                 19: (0, 12)}
+
+    def load_btf(self, f) -> bool:
+        # reads .BTF instead of DWARF unless told otherwise
+        if self.btf is False:
+            return False
+        with self.phase("elf_open"):
+            data = read_btf_section(f)
+        if data is None:
+            if self.btf:
+                raise ParseError(f"no .BTF section in {f.name}")
+            return False
+        with self.phase("btf_load"):
+            self.parse_btf(data)
+        return True
+
+    def parse_btf(self, data: bytes):
+        # BTF is deduplicated already and has no source locations. types,
+        # members, enumerators and parameters are keyed by the offset of
+        # their record in the section, like DIEs by theirs
+        magic, = struct.unpack_from("<H", data)
+        endian = "<" if magic == 0xeb9f else ">"
+        (_, version, _, hdr_len, type_off, type_len, str_off,
+         str_len) = struct.unpack_from(endian + "HBBIIIII", data)
+        if version != 1:
+            raise ParseError(f"cannot handle BTF version {version} yet")
+        btf_type = struct.Struct(endian + "III")
+        item = struct.Struct(endian + "III")
+        u32 = struct.Struct(endian + "I")
+        s32 = struct.Struct(endian + "i")
+        strings = hdr_len + str_off
+        def string(offset):
+            if not offset:
+                return None
+            start = strings + offset
+            return data[start:data.index(b"\0", start)].decode(ENCODING)
+        # where each type id starts; id 0 is void
+        starts = [None]
+        pos = hdr_len + type_off
+        end = pos + type_len
+        while pos < end:
+            starts.append(pos)
+            info = btf_type.unpack_from(data, pos)[1]
+            fixed, each = self.BTF_EXTRA.get(info >> 24 & 0x1f, (0, 0))
+            pos += 12 + fixed + each * (info & 0xffff)
+        def record(type_id):
+            if type_id >= len(starts):
+                # split BTF (kernel modules) refers into its base
+                raise ParseError(f"no BTF type {type_id}")
+            pos = starts[type_id]
+            name_off, info, size_or_type = btf_type.unpack_from(data, pos)
+            return (pos, string(name_off), info >> 24 & 0x1f,
+                    info & 0xffff, info >> 31, size_or_type)
+        def ref(type_id):
+            while type_id:
+                pos, _, kind, _, _, target = record(type_id)
+                if kind != self.BTF_TYPE_TAG:
+                    return pos
+                type_id = target
+            return None # void
+        def storage_size(type_id):
+            # size of the integer a bitfield is carved from
+            while type_id:
+                _, _, kind, _, _, size_or_type = record(type_id)
+                if kind in (1, 6, 16, 19):
+                    return size_or_type
+                if not kind in (8, 9, 10, 11, self.BTF_TYPE_TAG):
+                    break
+                type_id = size_or_type
+            return None
+        def int_bits(type_id):
+            # pre-kind_flag bitfields are encoded in the member's int type
+            pos, _, kind, _, _, size = record(type_id)
+            if kind != 1:
+                return None, 0
+            encoding = u32.unpack_from(data, pos + 12)[0]
+            bits = encoding & 0xff
+            offset = encoding >> 16 & 0xff
+            if bits == size * 8 and offset == 0:
+                return None, 0
+            return bits, offset
+        def node(tag, offset, name, **fields):
+            if name and self.is_invalid_name(name):
+                name = None
+            if name:
+                name = sys.intern(name)
+            values = dict(tag=sys.intern(tag), offset=offset, name=name,
+                          nickname=self.gen_nickname(tag, offset, name),
+                          type_goff=None, is_decl=False, decl_file=None,
+                          decl_line=None, data_member_location=None,
+                          byte_size=None, bit_size=None, bit_offset=None,
+                          deps=None, quantity=None)
+            values.update(fields)
+            if self.stats is not None:
+                self.stats.dies[tag] += 1
+            self.offset_to_node[offset] = Node(**values)
+        def params(proto_id):
+            # return type and DW_TAG_formal_parameter records of a FUNC_PROTO
+            pos, _, kind, vlen, _, ret = record(proto_id)
+            if kind != 13:
+                raise ParseError(f"BTF type {proto_id} is no FUNC_PROTO")
+            deps = []
+            for i in range(vlen):
+                name_off, type_id = struct.unpack_from(endian + "II", data,
+                                                       pos + 12 + 8 * i)
+                if not (name_off or type_id):
+                    continue # '...'
+                deps.append(pos + 12 + 8 * i)
+            return ref(ret), tuple(deps)
+        for type_id in range(1, len(starts)):
+            pos, name, kind, vlen, kind_flag, size_or_type = record(type_id)
+            tag = self.BTF_TAGS.get(kind)
+            if tag is None:
+                continue
+            try:
+                if kind in (1, 16):
+                    node(tag, pos, name, byte_size=size_or_type)
+                elif kind in (2, 8, 9, 10, 11):
+                    node(tag, pos, name, type_goff=ref(size_or_type))
+                elif kind == 3:
+                    elem, _, nelems = item.unpack_from(data, pos + 12)
+                    node(tag, pos, name, type_goff=ref(elem),
+                         quantity=nelems)
+                elif kind in (4, 5):
+                    members = []
+                    for i in range(vlen):
+                        mpos = pos + 12 + 12 * i
+                        name_off, mtype, moff = item.unpack_from(data, mpos)
+                        if kind_flag:
+                            bits, bit_off = moff >> 24, moff & 0xffffff
+                        else:
+                            bits, extra = int_bits(mtype)
+                            bit_off = moff + extra
+                        fields = dict(data_member_location=bit_off // 8)
+                        if bits:
+                            # DW_AT_bit_offset counts from the most
+                            # significant bit of the storage unit
+                            storage = storage_size(mtype) or 4
+                            mloc = bit_off // (storage * 8) * storage
+                            within = bit_off - mloc * 8
+                            if within + bits > storage * 8:
+                                mloc, within = bit_off // 8, bit_off % 8
+                            if endian == "<":
+                                within = storage * 8 - within - bits
+                            fields = dict(data_member_location=mloc,
+                                          byte_size=storage, bit_size=bits,
+                                          bit_offset=within)
+                        members.append((mpos, string(name_off), mtype,
+                                        fields))
+                    node(tag, pos, name, byte_size=size_or_type,
+                         deps=tuple(mpos for mpos, _, _, _ in members))
+                    for mpos, mname, mtype, fields in members:
+                        node("DW_TAG_member", mpos, mname,
+                             type_goff=ref(mtype), **fields)
+                elif kind in (6, 19):
+                    each = 8 if kind == 6 else 12
+                    values = []
+                    for i in range(vlen):
+                        epos = pos + 12 + each * i
+                        name_off = u32.unpack_from(data, epos)[0]
+                        if kind == 6:
+                            # producers rarely set kind_flag (signed), and
+                            # DTrace wants int32_t enumerators anyway
+                            value = s32.unpack_from(data, epos + 4)[0]
+                        else:
+                            lo, hi = struct.unpack_from(endian + "II", data,
+                                                        epos + 4)
+                            value = hi << 32 | lo
+                            if kind_flag and value >> 63:
+                                value -= 1 << 64
+                        values.append((epos, string(name_off), value))
+                    node(tag, pos, name, byte_size=size_or_type,
+                         deps=tuple(epos for epos, _, _ in values))
+                    for epos, ename, value in values:
+                        node("DW_TAG_enumerator", epos, ename,
+                             quantity=value)
+                elif kind == 7:
+                    if kind_flag:
+                        tag = "DW_TAG_union_type"
+                    node(tag, pos, name, is_decl=True)
+                elif kind == 12:
+                    ret, deps = params(size_or_type)
+                    node(tag, pos, name, type_goff=ret, deps=deps,
+                         is_decl=(vlen == 2)) # BTF_FUNC_EXTERN
+                elif kind == 13:
+                    ret, deps = params(type_id)
+                    node(tag, pos, name, type_goff=ret, deps=deps)
+                    for ppos in deps:
+                        name_off, ptype = struct.unpack_from(
+                            endian + "II", data, ppos)
+                        node("DW_TAG_formal_parameter", ppos,
+                             string(name_off), type_goff=ref(ptype))
+                elif kind == 14:
+                    node(tag, pos, name, type_goff=ref(size_or_type))
+            except ParseError as e:
+                if self.stats is not None:
+                    self.stats.error(e)
+                self.out.print(f"/* ignored {tag} at {pos}: {str(e)} */")
+
+    def parse_lazily(self, f, names: Iterable[str]) -> list:
+        # register only the named types; get_node() faults in the rest
+        if self.load_btf(f):
+            return self.find_roots(names)
+        import elftools.elf.elffile
+        with self.phase("elf_open"):
+            efile = elftools.elf.elffile.ELFFile(f)
+            self.dwinfo = efile.get_dwarf_info(relocate_dwarf_sections=False)
+        roots = []
+        for name in names:
+            found = self.find_type_die(efile, name)
+            if found is None:
+                self.out.print(f"/* no type named '{name}' */")
+                continue
+            self.faulted.add(found.offset)
+            self.register_die(found, self.get_cached_file_table(found.cu))
+            if not found.offset in self.offset_to_node:
+                # register_die() said why; find_roots() would not have it
+                self.out.print(f"/* no type named '{name}' */")
+                continue
+            roots.append(found.offset)
+        return roots
+
+    def get_cached_file_table(self, CU):
+        file_table = self.file_tables.get(CU.cu_offset)
+        if file_table is None:
+            file_table = self.get_file_table(CU)
+            self.file_tables[CU.cu_offset] = file_table
+        return file_table
+
+    def type_tags_for(self, name: str):
+        keyword, _, bare = name.strip().rpartition(" ")
+        tags = {tag for tag, kw in self.TAGS_for_types.items()
+                if kw and (not keyword or kw.endswith(keyword))}
+        return tags, bare
+
+    def find_type_die(self, efile, name: str):
+        tags, bare = self.type_tags_for(name)
+        def pick(dies):
+            # prefer a definition over declarations
+            found = None
+            for die in dies:
+                if not die.tag in tags:
+                    continue
+                if not self.is_c_unit(die.cu.get_top_DIE()):
+                    continue
+                if not "DW_AT_declaration" in die.attributes:
+                    return die
+                if found is None:
+                    found = die
+            return found
+        dwinfo = self.dwinfo
+        candidates = lookup_debug_names(efile, bare)
+        pubtypes = dwinfo.get_pubtypes()
+        if pubtypes is not None and bare in pubtypes:
+            candidates.append(pubtypes[bare].die_ofs)
+        found = pick(dwinfo.get_DIE_from_refaddr(goff) for goff in candidates)
+        if not found is None:
+            return found
+        # no index: scan only the top-level DIEs of each CU
+        def scan():
+            for CU in dwinfo.iter_CUs():
+                for die in CU.get_top_DIE().iter_children():
+                    attr = die.attributes.get("DW_AT_name")
+                    if attr is None or not die.tag in tags:
+                        continue
+                    value = attr.value
+                    if isinstance(value, bytes):
+                        value = value.decode(ENCODING)
+                    if value == bare:
+                        yield die
+        return pick(scan())
+
+    def name_index(self) -> Dict[str, list]:
+        index = {}
+        for node in self.offset_to_node.values():
+            if not node.name is None:
+                index.setdefault(node.name, []).append(node)
+        return index
+
+    def find_roots(self, names: Iterable[str],
+                   index: Dict[str, list] = None) -> list:
+        roots = []
+        for name in names:
+            tags, bare = self.type_tags_for(name)
+            found = None
+            if index is None:
+                nodes = self.offset_to_node.values()
+            else:
+                nodes = index.get(bare, ())
+            for node in nodes:
+                if node.name != bare or not node.tag in tags:
+                    continue
+                if found is None or (found.is_decl and not node.is_decl):
+                    found = node
+                if not found.is_decl:
+                    break
+            if found is None:
+                self.out.print(f"/* no type named '{name}' */")
+                continue
+            roots.append(found.offset)
+        return roots
+
+    D_KEYWORDS = {
+        "auto", "break", "case", "char", "const", "continue", "counter",
+        "default", "do", "double", "else", "enum", "extern", "float", "for",
+        "goto", "if", "import", "inline", "int", "long", "offsetof",
+        "probe", "provider", "register", "restrict", "return", "self",
+        "short", "signed", "sizeof", "static", "string", "stringof",
+        "struct", "switch", "this", "translator", "typedef", "union",
+        "unsigned", "userland", "void", "volatile", "while", "xlate",
+    }
+    def find_script_roots(self, script: str,
+                          index: Dict[str, list] = None) -> list:
+        # the types a D script mentions, in order: struct/union/enum tags
+        # (in casts, declarations, xlate and translator targets) are looked
+        # up like -t; any other identifier counts only if a typedef has
+        # that name. members after '.' and '->' are not type names
+        if index is None:
+            index = self.name_index()
+        text = re.sub(r'/\*.*?\*/|//[^\n]*|"(\\.|[^"\\])*"'
+                      r"|'(\\.|[^'\\])*'", " ", script, flags=re.S)
+        tokens = re.findall(r"->|[A-Za-z_]\w*|\S", text)
+        roots = {}
+        for i, token in enumerate(tokens):
+            if not (token[0].isalpha() or token[0] == "_"):
+                continue
+            previous = tokens[i - 1] if i > 0 else None
+            if previous in (".", "->", "struct", "union", "enum"):
+                continue
+            if token in ("struct", "union", "enum"):
+                if i + 1 < len(tokens) and re.match(r"[A-Za-z_]", tokens[i + 1]):
+                    for goff in self.find_roots([f"{token} {tokens[i + 1]}"],
+                                                index):
+                        roots.setdefault(goff)
+                continue
+            if token in self.D_KEYWORDS:
+                continue
+            for node in index.get(token, ()):
+                if node.tag == "DW_TAG_typedef":
+                    roots.setdefault(node.offset)
+                    break
+        return list(roots)
+
+    def gen_nickname(self, tag: str, offset: int, name: Optional[str]):
+        if name:
+            return name
+        keyword = self.TAGS_for_types.get(tag)
+        if keyword is None:
+            return None
+        return f"anon_{keyword}__GOFF0x{offset:x}"
+
+    def register_die(self, die, file_table):
+        def build_node(die):
+            def get_die_attr(die, attrname, default = None):
+                attr = die.attributes.get(attrname)
+                if attr is None:
+                    return default
+                if attr.form in {"DW_FORM_ref_addr",
+                                 "DW_FORM_data1",
+                                 "DW_FORM_data2",
+                                 "DW_FORM_data4",
+                                 "DW_FORM_data8",
+                                 "DW_FORM_sdata",
+                                 "DW_FORM_udata",}:
+                    return attr.value
+                if attr.form in {"DW_FORM_ref1",
+                                 "DW_FORM_ref2",
+                                 "DW_FORM_ref4",
+                                 "DW_FORM_ref8",
+                                 "DW_FORM_ref_udata",}:
+                    return attr.value + die.cu.cu_offset # CU-relative
+                if attr.form in {"DW_FORM_strp",}:
+                    return attr.value.decode(ENCODING)
+                raise ParseError(f"cannot handle {die.tag} {attr.form} yet")
+            name = get_die_attr(die, "DW_AT_name")
+            if name and self.is_invalid_name(name):
+                name = None
+            elif name:
+                name = sys.intern(name) # shared by every CU using the type
+            def get_decl_file(die):
+                decl_file = get_die_attr(die, 'DW_AT_decl_file')
+                if decl_file is None:
+                    return None
+                return file_table[decl_file]
+            def get_deps(die):
+                def gather(die, tag):
+                    return tuple(child.offset for child in die.iter_children()
+                                 if child.tag == tag)
+                if die.tag in ("DW_TAG_structure_type",
+                               "DW_TAG_class_type",
+                               "DW_TAG_union_type"):
+                    return gather(die, "DW_TAG_member")
+                if die.tag in ("DW_TAG_subprogram",
+                               "DW_TAG_subroutine_type"):
+                    return tuple(child.offset for child in die.iter_children()
+                                 if child.tag == "DW_TAG_formal_parameter")
+                if die.tag == "DW_TAG_enumeration_type":
+                    return tuple(child.offset for child in die.iter_children()
+                                 if child.tag == "DW_TAG_enumerator")
+                return None
+            def get_quantity(die):
+                if die.tag == "DW_TAG_array_type":
+                    for child in die.iter_children():
+                        if child.tag != "DW_TAG_subrange_type":
+                            continue
+                        return get_die_attr(child, "DW_AT_count")
+                if die.tag == "DW_TAG_enumerator":
+                    return get_die_attr(die, "DW_AT_const_value")
+                return None
+            def get_memory_location(die):
+                data_member_location = None
+                if die.tag == "DW_TAG_member":
+                    if "DW_AT_data_member_location" in die.attributes:
+                        return die.attributes["DW_AT_data_member_location"].value
+                    elif  "DW_AT_bit_offset" in die.attributes:
+                        return die.attributes["DW_AT_bit_offset"].value
+                return None
+            def get_layout(die):
+                # (data_member_location, byte_size, bit_size, bit_offset).
+                # DW_AT_data_bit_offset counts from the start of the struct;
+                # it is turned into the DW_AT_bit_offset of the smallest
+                # storage unit holding the field, as track() and the CTF
+                # writer expect
+                byte_size = get_die_attr(die, 'DW_AT_byte_size')
+                bit_size = get_die_attr(die, 'DW_AT_bit_size')
+                data_bit_offset = None
+                if die.tag == "DW_TAG_member":
+                    data_bit_offset = get_die_attr(die,
+                                                   "DW_AT_data_bit_offset")
+                if data_bit_offset is None:
+                    return (get_memory_location(die), byte_size, bit_size,
+                            get_die_attr(die, 'DW_AT_bit_offset'))
+                if bit_size is None:
+                    return data_bit_offset // 8, byte_size, None, None
+                within = data_bit_offset % 8
+                storage = 1
+                while within + bit_size > storage * 8:
+                    storage *= 2
+                if die.cu.dwarfinfo.config.little_endian:
+                    within = storage * 8 - within - bit_size
+                return data_bit_offset // 8, storage, bit_size, within
+            mloc, byte_size, bit_size, bit_offset = get_layout(die)
+            return Node(
+                tag = sys.intern(die.tag),
+                offset = die.offset,
+                name = name,
+                nickname = self.gen_nickname(die.tag, die.offset, name),
+                type_goff = get_die_attr(die, "DW_AT_type"),
+                is_decl = ("DW_AT_declaration" in die.attributes),
+                decl_file = get_decl_file(die),
+                decl_line = get_die_attr(die, 'DW_AT_decl_line'),
+                byte_size = byte_size,
+                data_member_location = mloc,
+                bit_size = bit_size,
+                bit_offset = bit_offset,
+                deps = get_deps(die),
+                quantity = get_quantity(die),
+            )
+        if self.stats is not None:
+            self.stats.dies[die.tag] += 1
+        try:
+            node = build_node(die)
+        except ParseError as e:
+            if self.stats is not None:
+                self.stats.error(e)
+            self.out.print(f"/* ignored {die.tag} at {die.offset}: {str(e)} */")
+            self.faulted.add(die.offset) # get_node() would only fail again
+            return
+        self.offset_to_node[node.offset] = node
+        if not (die.tag in self.TAGS_for_types):
+            return
+        if self.VERBOSE > 1 and node.name:
+            self.out.print(f"/* '{node.name}' is {node.tag}"
+                           f" GOFF0x{node.offset:x},"
+                           f" {node.src_location()} */")
+
+    def parse_file_cached(self, f, cache: "TypeCache", jobs: int = 1):
+        if self.load_btf(f):
+            return # loading BTF is as fast as loading the cache
+        # the graph and its log depend on how it was parsed
+        key = cache.key_for(f, native=self.native_decoder, prune=self.prune,
+                            verbose=self.VERBOSE)
+        with self.phase("cache_load"):
+            cached = cache.load(key)
+        if cached is not None:
+            nodes, log = cached
+            self.offset_to_node = self.new_store(nodes) if self.compact else nodes
+            self.out.write(log)
+            return
+        out = self.out
+        self.out = Emitter()
+        try:
+            self.parse_file(f, jobs=jobs)
+            log = self.out.getvalue()
+        finally:
+            self.out = out
+        self.out.write(log)
+        cache.store(key, self.offset_to_node, log)
+
+    def parse_parallel(self, path: str, dwinfo, cu_filter, jobs: int):
+        import concurrent.futures
+        # contiguous chunks of roughly the same size, several per worker
+        # so that one huge CU does not leave the others idle
+        sizes = [(CU.cu_offset, CU.size) for CU in dwinfo.iter_CUs()]
+        total = sum(size for _, size in sizes)
+        limit = max(1, total // (jobs * 4))
+        chunks = []
+        chunk = []
+        chunk_size = 0
+        for cu_offset, size in sizes:
+            chunk.append(cu_offset)
+            chunk_size += size
+            if chunk_size >= limit:
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            chunks.append(chunk)
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            # results come back in submission order, so merging keeps
+            # offset_to_node ordered exactly as a serial walk would
+            for offset_to_node, log, stats in pool.map(
+                    _parse_cu_chunk,
+                    [(path, chunk, cu_filter, self.VERBOSE,
+                      self.stats is not None, self.native_decoder,
+                      self.prune) for chunk in chunks]):
+                self.out.write(log)
+                self.offset_to_node.update(offset_to_node)
+                if stats is not None:
+                    self.stats.merge(stats)
+
+    # offsets of the i-th file in a batch start at i << FILE_SHIFT
+    FILE_SHIFT = 40
+
+    def parse_files(self, paths: list, jobs: int = 1) -> list:
+        import concurrent.futures
+        tasks = [(path, self.VERBOSE, self.stats is not None,
+                  self.native_decoder, self.prune, self.btf) for path in paths]
+        files = []
+        with contextlib.ExitStack() as stack:
+            if jobs > 1 and len(paths) > 1:
+                pool = stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(
+                        min(jobs, len(paths))))
+                results = pool.map(_parse_elf, tasks)
+            else:
+                results = map(_parse_elf, tasks)
+            for index, (offset_to_node, log, stats) in enumerate(results):
+                if stats is not None:
+                    self.stats.merge(stats)
+                offsets = self.absorb(offset_to_node,
+                                      index << self.FILE_SHIFT)
+                files.append((offsets, log))
+        return files
+
+    def absorb(self, offset_to_node, base: int) -> list:
+        def shift(goff):
+            return None if goff is None else goff + base
+        offsets = []
+        for node in offset_to_node.values():
+            changes = dict(offset=node.offset + base,
+                           type_goff=shift(node.type_goff))
+            if not node.deps is None:
+                changes["deps"] = tuple(goff + base for goff in node.deps)
+            if node.name is None and node.nickname:
+                # anonymous nicknames carry the offset
+                changes["nickname"] = node.nickname.replace(
+                    f"__GOFF0x{node.offset:x}",
+                    f"__GOFF0x{node.offset + base:x}")
+            node = dataclasses.replace(node, **changes)
+            self.offset_to_node[node.offset] = node
+            offsets.append(node.offset)
+        return offsets
+
+    def dedup(self) -> Dict[int, int]:
+        # partition refinement: start from the local shape of each DIE and
+        # split classes by the classes they refer to until nothing changes.
+        # the fixpoint treats cyclic types (e.g. linked lists) correctly.
+        def shape(node):
+            mloc = node.data_member_location
+            if isinstance(mloc, list):
+                mloc = tuple(mloc)
+            return (node.tag, node.name, node.is_decl, node.byte_size,
+                    node.bit_size, node.bit_offset, mloc, node.quantity,
+                    None if node.deps is None else len(node.deps))
+        nodes = list(self.offset_to_node.values())
+        shapes = {}
+        classes = {node.offset: shapes.setdefault(shape(node), len(shapes))
+                   for node in nodes}
+        count = len(shapes)
+        def ref(goff):
+            if goff is None:
+                return -1
+            # dangling references only match themselves
+            return classes.get(goff, ("missing", goff))
+        while True:
+            signatures = {}
+            refined = {}
+            for node in nodes:
+                deps = None
+                if not node.deps is None:
+                    deps = tuple(ref(goff) for goff in node.deps)
+                key = (classes[node.offset], ref(node.type_goff), deps)
+                refined[node.offset] = signatures.setdefault(key, len(signatures))
+            classes = refined
+            if len(signatures) == count:
+                break
+            count = len(signatures)
+
+        canonical = {}
+        for node in nodes:
+            canonical.setdefault(classes[node.offset], node.offset)
+        def canon(goff):
+            if goff is None or not goff in classes:
+                return goff
+            return canonical[classes[goff]]
+        remap = {}
+        offset_to_node = self.new_store()
+        for node in nodes:
+            goff = canonical[classes[node.offset]]
+            remap[node.offset] = goff
+            if goff != node.offset:
+                continue
+            type_goff = canon(node.type_goff)
+            deps = node.deps
+            if not deps is None:
+                deps = tuple(canon(dep) for dep in deps)
+            if type_goff != node.type_goff or deps != node.deps:
+                node = dataclasses.replace(node, type_goff=type_goff, deps=deps)
+            offset_to_node[goff] = node
+        if self.VERBOSE > 0:
+            self.out.print(f"/* dedup: {len(nodes)} -> {len(offset_to_node)} nodes */")
+        self.offset_to_node = offset_to_node
+        self.decl_cache.clear()
+        self.hash_cache.clear()
+        return remap
 
     def get_node(self, goff: Optional[int]) -> Optional[Node]:
         if goff is None:
@@ -199,7 +1181,13 @@ class TypeDG:
         try:
             return self.offset_to_node[goff]
         except KeyError as e:
-            raise ParseError(f"no node for GOFF=0x{goff:x}") from e
+            if self.dwinfo is None or goff in self.faulted:
+                raise ParseError(f"no node for GOFF=0x{goff:x}") from e
+        self.faulted.add(goff)
+        die = self.dwinfo.get_DIE_from_refaddr(goff)
+        self.faulted_units[die.cu.cu_offset] = die.cu
+        self.register_die(die, self.get_cached_file_table(die.cu))
+        return self.get_node(goff)
 
     # _dtrace_typedefs_64
     shown_for_dtrace_typedefs = dict( ("typedef " + k, "defined") for k in (
@@ -208,20 +1196,475 @@ class TypeDG:
         "uint8_t", "uint16_t", "uint32_t", "uint64_t",
         "uchar_t", "ushort_t", "uint_t", "ulong_t", "u_longlong_t",
         "ptrdiff_t", "uintptr_t", "size_t", "id_t", "pid_t"))
-    def explain(self, shown, checker: Callable[[Node], bool] = None):
-        for goff, node in self.offset_to_node.items():
+    def iter_roots(self, checker: Callable[[Node], bool] = None,
+                   roots: Iterable[int] = None):
+        if roots is None:
+            nodes = self.offset_to_node.values()
+        else:
+            nodes = (self.get_node(goff) for goff in roots)
+        for node in nodes:
             if not node.tag in self.TAGS_for_types:
                 continue
             if checker and not checker(node):
                 continue
+            yield node
+
+    def explain(self, shown, checker: Callable[[Node], bool] = None,
+                roots: Iterable[int] = None, done: Dict = None,
+                reserved: Set[str] = None):
+        # 'reserved' collects the typedef names members must not use; like
+        # 'shown' it belongs to one header
+        if done is None:
+            done = {}
+        if reserved is None:
+            reserved = set(self.RESERVED_NAMES)
+        for node in self.iter_roots(checker, roots):
             try:
                 if self.VERBOSE > 0:
-                    print(f"\n//// trying {node.tag} {node.nickname}")
-                self.track(node, shown, [])
+                    self.out.print(f"\n//// trying {node.tag} {node.nickname}")
+                self.track(node, shown, [], done=done, reserved=reserved)
             except ParseError as e:
-                print(f"/* skipped GOFF=0x{node.offset:x}"
-                      f" {node.tag} '{node.nickname}'"
-                      f" at {node.src_location()}: {str(e)} */")
+                if self.stats is not None:
+                    self.stats.error(e)
+                self.out.print(f"/* skipped GOFF=0x{node.offset:x}"
+                               f" {node.tag} '{node.nickname}'"
+                               f" at {node.src_location()}: {str(e)} */")
+        # a caller writing to a sink should not have to know it is buffered
+        self.out.flush()
+
+    def render(self, shown, checker: Callable[[Node], bool] = None,
+               roots: Iterable[int] = None, done: Dict = None,
+               reserved: Set[str] = None) -> str:
+        out = self.out
+        self.out = Emitter()
+        try:
+            self.explain(shown, checker, roots, done, reserved)
+            return self.out.getvalue()
+        finally:
+            self.out = out
+
+    def explain_streaming(self, f, checker: Callable[[Node], bool] = None,
+                          cu_filter = None):
+        # parses, explains and drops one CU at a time, so only the largest
+        # CU is ever held. 'shown' and 'reserved' carry over and keep later
+        # CUs from repeating what was emitted; DIEs in other CUs (ref_addr)
+        # are faulted in as stubs and dropped with the CU that needed them
+        if self.load_btf(f):
+            # BTF has no CUs and is small enough to be explained at once
+            with self.phase("explain"):
+                self.explain({}, checker)
+            return
+        dwinfo = self.open_dwarf(f)
+        self.dwinfo = dwinfo
+        shown = {}
+        reserved = set(self.RESERVED_NAMES)
+        def explain_unit(CU):
+            with self.phase("explain"):
+                self.explain(shown, checker, None, {}, reserved)
+            self.offset_to_node = self.new_store()
+            self.faulted = set()
+            self.decl_cache.clear()
+            self.hash_cache.clear()
+            self.file_tables.clear()
+            # parse_units() drops what elftools cached of CU itself
+            self.drop_die_caches(dwinfo, self.faulted_units.values())
+            self.faulted_units = {}
+        self.parse_units(dwinfo, dwinfo.iter_CUs(), cu_filter,
+                         on_unit=explain_unit)
+
+    def root_key(self, node: Node) -> str:
+        keyword = self.TAGS_for_types.get(node.tag)
+        if keyword is None:
+            keyword = node.tag[len("DW_TAG_"):]
+        return f"{keyword} {node.nickname}"
+
+    def type_hash(self, node: Node) -> str:
+        # layout of the type itself; named types it refers to only count
+        # by name, so a change shows up only in the type that changed
+        import hashlib
+        cache = self.hash_cache
+        pending = set()
+        def ref(goff):
+            if goff is None:
+                return "void"
+            try:
+                target = self.get_node(goff)
+            except ParseError:
+                return "missing"
+            keyword = self.TAGS_for_types.get(target.tag)
+            if keyword and target.name:
+                return f"{keyword} {target.name}"
+            return digest(target)
+        def dep(goff):
+            # members may not have been faulted in yet on the lazy path
+            try:
+                return digest(self.get_node(goff))
+            except ParseError:
+                return "missing"
+        def digest(node):
+            value = cache.get(node.offset)
+            if value is not None:
+                return value
+            if node.offset in pending:
+                return "cycle"
+            pending.add(node.offset)
+            mloc = node.data_member_location
+            if isinstance(mloc, list):
+                mloc = tuple(mloc)
+            fields = (node.tag, node.name, node.is_decl, node.byte_size,
+                      node.bit_size, node.bit_offset, mloc, node.quantity,
+                      ref(node.type_goff),
+                      None if node.deps is None else
+                      tuple(dep(goff) for goff in node.deps))
+            pending.discard(node.offset)
+            value = hashlib.blake2b(repr(fields).encode(ENCODING),
+                                    digest_size=16).hexdigest()
+            cache[node.offset] = value
+            return value
+        return digest(node)
+
+    MANIFEST_FORMAT = 1
+    def explain_split(self, files: list, paths: list, directory: str,
+                      checker: Callable[[Node], bool] = None,
+                      remap: Dict[int, int] = None):
+        # types found in more than one file go to base.h, which every
+        # per-file header includes
+        if remap is None:
+            remap = {}
+        owners = collections.Counter()
+        per_file = []
+        for offsets, _ in files:
+            roots = list(dict.fromkeys(remap.get(goff, goff)
+                                       for goff in offsets))
+            owners.update(roots)
+            per_file.append(roots)
+        shared = [goff for goff in self.offset_to_node if owners[goff] > 1]
+        os.makedirs(directory, exist_ok=True)
+        out = self.out
+        shown = {}
+        reserved = set(self.RESERVED_NAMES)
+        try:
+            with open(os.path.join(directory, "base.h"), 'w',
+                      encoding=ENCODING) as sink:
+                self.out = Emitter(sink)
+                self.out.print("#ifndef DWARF2DTRACE_BASE_H")
+                self.out.print("#define DWARF2DTRACE_BASE_H")
+                self.explain(shown, checker, shared, reserved=reserved)
+                self.out.print("#endif")
+                self.out.flush()
+            names = set()
+            for index, (path, (_, log), roots) in enumerate(
+                    zip(paths, files, per_file)):
+                name = os.path.basename(path) + ".h"
+                if name in names or name == "base.h":
+                    name = f"{index}-{name}"
+                names.add(name)
+                with open(os.path.join(directory, name), 'w',
+                          encoding=ENCODING) as sink:
+                    self.out = Emitter(sink)
+                    self.out.print('#include "base.h"')
+                    self.out.write(log)
+                    # every header starts from what base.h defines
+                    self.explain(dict(shown), checker,
+                                 [goff for goff in roots
+                                  if owners[goff] == 1],
+                                 reserved=set(reserved))
+                    self.out.flush()
+        finally:
+            self.out = out
+
+    def shard_of(self, node: Node) -> str:
+        # the directory a type is declared in, or the file's stem where the
+        # line table has no directory
+        if node.decl_file is None:
+            return "nowhere"
+        key = (os.path.dirname(node.decl_file)
+               or os.path.splitext(os.path.basename(node.decl_file))[0])
+        name = re.sub(r"[^A-Za-z0-9]+", "_", key).strip("_") or "root"
+        return name + "_" if name == "all" else name
+
+    def value_deps(self, root: Node):
+        # named types track() needs defined, not just declared, to emit
+        # 'root'. anonymous types are walked through; structs and unions
+        # behind pointers only get declared
+        compounds = ("DW_TAG_structure_type", "DW_TAG_class_type",
+                     "DW_TAG_union_type")
+        stack = [(root, False)]
+        seen = set()
+        while stack:
+            node, incomplete = stack.pop()
+            if node is None or (node.offset, incomplete) in seen:
+                continue
+            seen.add((node.offset, incomplete))
+            tag = node.tag
+            if (node.offset != root.offset and node.name
+                    and self.TAGS_for_types.get(tag)):
+                if not (tag in compounds and (incomplete or node.is_decl)):
+                    yield node
+                continue
+            try:
+                if tag == "DW_TAG_pointer_type":
+                    stack.append((self.get_node(node.type_goff), True))
+                elif tag in ("DW_TAG_array_type", "DW_TAG_reference_type",
+                             "DW_TAG_rvalue_reference_type"):
+                    stack.append((self.get_node(node.type_goff), False))
+                elif tag in self.TAGS_for_qualifiers:
+                    stack.append((self.get_node(node.type_goff), incomplete))
+                elif tag in ("DW_TAG_subprogram", "DW_TAG_subroutine_type"):
+                    stack.append((self.get_node(node.type_goff), False))
+                    for child_goff in node.deps:
+                        child = self.get_node(child_goff)
+                        if child.tag == "DW_TAG_formal_parameter":
+                            stack.append((self.get_node(child.type_goff),
+                                          incomplete))
+                elif tag == "DW_TAG_typedef":
+                    if not (node.nickname.startswith("__builtin")
+                            or node.nickname in self.PREDEFINED_TYPES):
+                        stack.append((self.get_node(node.type_goff),
+                                      incomplete))
+                elif tag in compounds and not (incomplete or node.is_decl):
+                    for child_goff in node.deps:
+                        child = self.get_node(child_goff)
+                        stack.append((self.get_node(child.type_goff), False))
+            except ParseError:
+                continue # track() reports it
+
+    def explain_shards(self, directory: str,
+                       checker: Callable[[Node], bool] = None,
+                       roots: Iterable[int] = None) -> list:
+        # one header per shard_of(), each with its include guard. a type
+        # needed complete from another shard comes from including that
+        # shard; shards that would include each other are merged into one
+        # and the others become stubs including it. headers whose text did
+        # not change are left alone; returns the names rewritten
+        found = []
+        queue = collections.deque(self.iter_roots(checker, roots))
+        queued = {node.offset for node in queue}
+        while queue:
+            root = queue.popleft()
+            deps = list(self.value_deps(root))
+            found.append((root, deps))
+            for dep in deps:
+                if not dep.offset in queued:
+                    queued.add(dep.offset)
+                    queue.append(dep)
+        # a name is defined by the first shard with a definition of it, so
+        # that all.h sees one definition as the monolithic header would.
+        # declarations (and types without a decl_file) go where the
+        # definition went
+        claimed = {}
+        for root, _ in found:
+            if not root.is_decl and root.decl_file is not None:
+                claimed.setdefault(self.root_key(root), self.shard_of(root))
+        def home_of(node):
+            return claimed.get(self.root_key(node)) or self.shard_of(node)
+        members = {}
+        includes = {}
+        for root, deps in found:
+            home = home_of(root)
+            members.setdefault(home, []).append(root.offset)
+            needs = includes.setdefault(home, {})
+            for dep in deps:
+                dep_home = home_of(dep)
+                if dep_home != home:
+                    needs[dep_home] = True
+        # Tarjan's SCCs come out dependencies first
+        order = {shard: i for i, shard in enumerate(members)}
+        index = {}
+        low = {}
+        stack = []
+        components = []
+        for start in members:
+            if start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            work = [(start, iter(includes[start]))]
+            while work:
+                v, children = work[-1]
+                for w in children:
+                    if not w in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        work.append((w, iter(includes[w])))
+                        break
+                    if w in stack:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            component.append(w)
+                            if w == v:
+                                break
+                        components.append(sorted(component, key=order.get))
+        merged_into = {shard: component[0] for component in components
+                       for shard in component}
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        def write(name, lines):
+            path = os.path.join(directory, name + ".h")
+            guard = f"DWARF2DTRACE_{name.upper()}_H"
+            text = "".join([f"#ifndef {guard}\n#define {guard}\n"]
+                           + lines + ["#endif\n"])
+            try:
+                with open(path, encoding=ENCODING) as f:
+                    if f.read() == text:
+                        return
+            except FileNotFoundError:
+                pass
+            with open(path, 'w', encoding=ENCODING) as f:
+                f.write(text)
+            written.append(name)
+        added = {} # what each shard defines on top of its includes
+        closure = {}
+        for component in components:
+            name = component[0]
+            deps = {}
+            for shard in component:
+                for dep in includes[shard]:
+                    if merged_into[dep] != name:
+                        deps[merged_into[dep]] = True
+            closure[name] = {}
+            for dep in deps:
+                closure[name].update(closure[dep])
+                closure[name][dep] = True
+            shown = {}
+            for dep in closure[name]:
+                for key, state in added[dep].items():
+                    if shown.get(key) != "defined":
+                        shown[key] = state
+            reserved = set(self.RESERVED_NAMES)
+            reserved.update(key[len("typedef "):] for key in shown
+                            if key.startswith("typedef "))
+            before = dict(shown)
+            text = self.render(shown, None,
+                               [goff for shard in component
+                                for goff in members[shard]], {}, reserved)
+            added[name] = {key: state for key, state in shown.items()
+                           if before.get(key) != state}
+            lines = [f'#include "{dep}.h"\n' for dep in deps]
+            if len(component) > 1:
+                lines.insert(0, f"/* also the types of"
+                                f" {', '.join(component[1:])} */\n")
+            write(name, lines + [text])
+            for shard in component[1:]:
+                write(shard, [f'#include "{name}.h"\n'])
+        write("all", [f'#include "{component[0]}.h"\n'
+                      for component in components])
+        return written
+
+    @classmethod
+    def check_manifest(cls, manifest) -> None:
+        # what explain_incremental() reads of a manifest, so that a stale
+        # or edited file is reported instead of failing half way
+        if not isinstance(manifest, dict):
+            raise ParseError("manifest is not a JSON object")
+        if manifest.get("format") != cls.MANIFEST_FORMAT:
+            raise ParseError(f"unknown manifest format"
+                             f" {manifest.get('format')!r}")
+        types = manifest.get("types")
+        if not isinstance(types, dict):
+            raise ParseError("manifest has no \"types\" object")
+        for key, entry in types.items():
+            if not (isinstance(entry, dict)
+                    and isinstance(entry.get("hash"), str)
+                    and isinstance(entry.get("text"), str)
+                    and isinstance(entry.get("defines"), list)
+                    and all(isinstance(name, str)
+                            for name in entry["defines"])):
+                raise ParseError(f"bad manifest entry for {key!r}")
+
+    def explain_incremental(self, shown, checker: Callable[[Node], bool] = None,
+                            roots: Iterable[int] = None,
+                            previous: Dict = None,
+                            reserved: Set[str] = None) -> Dict:
+        # emits only the types whose hash differs from 'previous' (a
+        # manifest written by an earlier run) and returns the new manifest
+        import hashlib
+        old = {}
+        if previous is not None:
+            self.check_manifest(previous)
+            old = previous["types"]
+        if reserved is None:
+            reserved = set(self.RESERVED_NAMES)
+        ordered = list(self.iter_roots(checker, roots))
+        grouped = {}
+        for node in ordered:
+            grouped.setdefault(self.root_key(node), []).append(node)
+        hashes = {}
+        for key, nodes in grouped.items():
+            if len(nodes) == 1:
+                hashes[key] = self.type_hash(nodes[0])
+            else:
+                joined = ",".join(self.type_hash(node) for node in nodes)
+                hashes[key] = hashlib.blake2b(joined.encode(ENCODING),
+                                              digest_size=16).hexdigest()
+        added = [key for key in grouped if not key in old]
+        changed = [key for key in grouped
+                   if key in old and old[key]["hash"] != hashes[key]]
+        removed = [key for key in old if not key in grouped]
+        # the 'shown' name each root defines itself
+        owner = {}
+        for key, nodes in grouped.items():
+            for node in nodes:
+                name = node.nickname
+                if node.tag == "DW_TAG_typedef":
+                    name = "typedef " + name
+                owner.setdefault(name, key)
+        # an old text that also defined a type emitted anew is stale: it is
+        # emitted again, which may in turn make other texts stale
+        redone = set(added) | set(changed)
+        dependent = []
+        while True:
+            stale = [key for key in grouped if not key in redone
+                     and any(owner.get(name) in redone
+                             for name in old[key]["defines"])]
+            if not stale:
+                break
+            redone.update(stale)
+            dependent += stale
+        unchanged = {key for key in grouped if not key in redone}
+        for key in unchanged:
+            # these are already in the previous header
+            for name in old[key]["defines"]:
+                shown[name] = "defined"
+                if name.startswith("typedef "):
+                    reserved.add(name[len("typedef "):])
+        if previous is not None:
+            self.out.print(f"/* changes: {len(added)} added,"
+                           f" {len(changed)} changed, {len(removed)} removed,"
+                           f" {len(dependent)} re-emitted,"
+                           f" {len(unchanged)} unchanged")
+            for label, keys in (("added", added), ("changed", changed),
+                                ("removed", removed),
+                                ("re-emitted", dependent)):
+                for key in keys:
+                    self.out.print(f" * {label}: {key}")
+            self.out.print(" */")
+        manifest = {key: old[key] for key in unchanged}
+        done = {}
+        for node in ordered:
+            key = self.root_key(node)
+            if key in unchanged:
+                continue
+            entry = manifest.setdefault(
+                key, {"hash": hashes[key], "text": "", "defines": []})
+            before = dict(shown)
+            text = self.render(shown, None, [node.offset], done, reserved)
+            self.out.write(text)
+            entry["text"] += text
+            entry["defines"] += [name for name, state in shown.items()
+                                 if state == "defined"
+                                 and before.get(name) != "defined"]
+        self.out.flush()
+        return {"format": self.MANIFEST_FORMAT, "types": manifest}
+
     RESERVED_NAMES = {
         "counter",
         "import",
@@ -231,7 +1674,25 @@ class TypeDG:
         "probe",
         "provider", # user-land DTrace
     }
+    DECL_NAME = "\0" # stands for the declared name in decl_cache
     def gen_decl(self, node: Optional[Node], name: str = None) -> str:
+        # declarators only depend on the node, so each node is rendered
+        # once and the name is spliced in afterwards
+        if node is None or name == "":
+            return self.render_decl(node, name)
+        if name is None:
+            key = (node.offset, None)
+        else:
+            key = (node.offset, self.DECL_NAME)
+        decl = self.decl_cache.get(key)
+        if decl is None:
+            decl = self.render_decl(node, key[1])
+            self.decl_cache[key] = decl
+        if name is None:
+            return decl
+        return decl.replace(self.DECL_NAME, name)
+
+    def render_decl(self, node: Optional[Node], name: str = None) -> str:
         if node is None:
             if name is None:
                 return "void"
@@ -271,7 +1732,11 @@ class TypeDG:
                 postfix = f"[1/*to be 0*/]"
             else:
                 postfix = f"[{node.quantity}]"
-            return (self.gen_decl(self.get_node(node.type_goff))
+            elemtype = self.get_node(node.type_goff)
+            if elemtype is not None and elemtype.tag == "DW_TAG_array_type":
+                # BTF spells int m[3][4] as an array of arrays
+                return self.gen_decl(elemtype, (name or "") + postfix)
+            return (self.gen_decl(elemtype)
                     + " " + name + postfix)
 
         if self.TAGS_for_qualifiers.get(node.tag):
@@ -300,7 +1765,75 @@ class TypeDG:
     def track(self, node: Optional[Node],
               shown: Dict[str, str],
               stack: Iterable[int],
-              maybe_incomplete: bool = False):
+              maybe_incomplete: bool = False,
+              done: Dict = None,
+              reserved: Set[str] = None):
+        # runs track_steps() coroutines on an explicit stack instead of
+        # recursing. a state is (node, maybe_incomplete); once one has
+        # succeeded it is not walked again for the same 'done' memo.
+        # failures are not memoized since 'shown' is keyed by name and a
+        # namesake may satisfy the state later. a request for a state that
+        # is still open on the stack closes a cycle, which is broken by
+        # asking for the incomplete (forward-declared) state instead.
+        if node is None:
+            return
+        if done is None:
+            done = {}
+        if reserved is None:
+            reserved = set(self.RESERVED_NAMES)
+        key = (node.offset, bool(maybe_incomplete))
+        if key in done:
+            return
+        frames = [(self.track_steps(node, shown, stack, reserved,
+                                    maybe_incomplete), key)]
+        active = {key}
+        error = None
+        while frames:
+            steps, key = frames[-1]
+            try:
+                if error is None:
+                    request = steps.send(None)
+                else:
+                    request = steps.throw(error)
+            except StopIteration:
+                frames.pop()
+                active.discard(key)
+                done[key] = True
+                error = None
+                continue
+            except ParseError as e:
+                frames.pop()
+                active.discard(key)
+                error = e
+                continue
+            error = None
+            child, child_stack, child_incomplete = request
+            if child is None:
+                continue
+            child_key = (child.offset, bool(child_incomplete))
+            if child_key in active:
+                if self.VERBOSE > 0:
+                    self.out.print(f"/* {child.nickname} closes a cycle */")
+                child_key = (child.offset, True)
+                child_incomplete = True
+                if child_key in active:
+                    continue
+            if child_key in done:
+                continue
+            frames.append((self.track_steps(child, shown, child_stack,
+                                            reserved, child_incomplete),
+                           child_key))
+            active.add(child_key)
+        if error:
+            raise error
+
+    def track_steps(self, node: Node,
+                    shown: Dict[str, str],
+                    stack: Iterable[int],
+                    reserved: Set[str],
+                    maybe_incomplete: bool = False):
+        # yields (node, stack, maybe_incomplete) for every dependency to
+        # be tracked first; track() throws their ParseErrors back in here
         if node is None:
             return
         if node.tag == "DW_TAG_base_type":
@@ -308,35 +1841,35 @@ class TypeDG:
 
         if node.tag == "DW_TAG_pointer_type":
             try:
-                self.track(self.get_node(node.type_goff), shown, stack, True)
+                yield (self.get_node(node.type_goff), stack, True)
             except ParseError as e:
                 raise ParseError("pointer -> " + str(e)) from e
             return
 
         if node.tag == "DW_TAG_array_type":
             elemtype = self.get_node(node.type_goff)
-            self.track(elemtype, shown, stack)
+            yield (elemtype, stack, False)
             return
 
         if node.tag == "DW_TAG_reference_type":
             dep = self.get_node(node.type_goff)
             try:
-                self.track(dep, shown, stack)
-            except:
+                yield (dep, stack, False)
+            except ParseError as e:
                 raise ParseError("reference -> " + str(e)) from e
             return
 
         if node.tag == "DW_TAG_rvalue_reference_type":
             dep = self.get_node(node.type_goff)
             try:
-                self.track(dep, shown, stack)
-            except:
+                yield (dep, stack, False)
+            except ParseError as e:
                 raise ParseError("rvalue -> " + str(e)) from e
             return
 
         if node.tag in self.TAGS_for_qualifiers:
             try:
-                self.track(self.get_node(node.type_goff), shown, stack, maybe_incomplete)
+                yield (self.get_node(node.type_goff), stack, maybe_incomplete)
             except ParseError as e:
                 raise ParseError("qual -> " + str(e)) from e
             return
@@ -344,13 +1877,13 @@ class TypeDG:
 
         if node.tag in ("DW_TAG_subprogram",
                         "DW_TAG_subroutine_type"):
-            self.track(self.get_node(node.type_goff), shown, stack)
+            yield (self.get_node(node.type_goff), stack, False)
             for child_goff in node.deps:
                 child = self.get_node(child_goff)
                 if child.tag != "DW_TAG_formal_parameter":
                     continue
                 try:
-                    self.track(self.get_node(child.type_goff), shown, stack, maybe_incomplete)
+                    yield (self.get_node(child.type_goff), stack, maybe_incomplete)
                 except ParseError as e:
                     raise ParseError("formal-parameter -> " + str(e)) from e
             return
@@ -369,22 +1902,22 @@ class TypeDG:
                 orig = "None"
             if node.nickname.startswith("__builtin"):
                 if self.VERBOSE > 0:
-                    print(f"/* skip {node.nickname}, must be system-defined */");
+                    self.out.print(f"/* skip {node.nickname}, must be system-defined */");
                 return
             if node.nickname in self.PREDEFINED_TYPES:
                 return
             try:
-                self.track(dep, shown, stack, maybe_incomplete)
+                yield (dep, stack, maybe_incomplete)
             except ParseError as e:
                 raise ParseError("typedef -> " + str(e)) from e
             cur = shown.get(key)
             if cur:
                 return
-            print(f"\n/*  GOFF0x{node.offset:x} @ {node.src_location()}, "
-                  f"define {orig} as '{node.nickname}' */")
-            print(f"typedef {self.gen_decl(dep, node.nickname)};")
+            self.out.print(f"\n/*  GOFF0x{node.offset:x} @ {node.src_location()}, "
+                           f"define {orig} as '{node.nickname}' */")
+            self.out.print(f"typedef {self.gen_decl(dep, node.nickname)};")
             shown[key] = "defined"
-            self.RESERVED_NAMES.add(node.nickname)
+            reserved.add(node.nickname)
             return
 
         if node.tag in ("DW_TAG_structure_type",
@@ -393,25 +1926,25 @@ class TypeDG:
             key = node.nickname
             cur = shown.get(key)
             if self.VERBOSE > 0:
-                print(f"/* <{depth}> '{node.nickname}':"
-                      f" maybe_incomplete={maybe_incomplete}"
-                      f" is_decl={node.is_decl} cur={cur} */")
+                self.out.print(f"/* <{depth}> '{node.nickname}':"
+                               f" maybe_incomplete={maybe_incomplete}"
+                               f" is_decl={node.is_decl} cur={cur} */")
             if cur == "defined":
                 if self.VERBOSE > 0:
-                    print(f"/*  <{depth}> skip (defined) */")
+                    self.out.print(f"/*  <{depth}> skip (defined) */")
                 return
             if (maybe_incomplete or node.is_decl) and not (cur is None):
                 if self.VERBOSE > 0:
-                    print(f"/*  <{depth}> skip (declared) */")
+                    self.out.print(f"/*  <{depth}> skip (declared) */")
                 return
             if maybe_incomplete or node.is_decl:
                 if self.VERBOSE > 0:
-                    print(f"/*  <{depth}> decl-only */")
+                    self.out.print(f"/*  <{depth}> decl-only */")
                 postfix = ";"
                 if stack and len(stack) > 1:
                     p = stack[-2]
                     postfix += (f"/* for GOFF0x{p.offset:x} {p.nickname} */")
-                print(self.gen_decl(node) + postfix)
+                self.out.print(self.gen_decl(node) + postfix)
                 shown[key] = "declared"
                 return
             members = []
@@ -429,18 +1962,18 @@ class TypeDG:
                 mname = child.name
                 if not mname:
                     mname = f"unnamed{len(members)}__off0x{mloc:x}"
-                while mname in self.RESERVED_NAMES:
+                while mname in reserved:
                     mname = mname + "_"
                 if self.VERBOSE > 0:
-                    print(f"// tracking {node.nickname} :: {mname}")
+                    self.out.print(f"// tracking {node.nickname} :: {mname}")
                 try:
                     if mtype in stack:
                         if self.VERBOSE > 0:
-                            print(f"/* {mtype} is in {stack} */")
+                            self.out.print(f"/* {mtype} is in {stack} */")
                         if shown.get(mtype.nickname) is None:
-                            self.track(mtype, shown, stack, True)
+                            yield (mtype, stack, True)
                     else:
-                        self.track(mtype, shown, stack, maybe_incomplete)
+                        yield (mtype, stack, maybe_incomplete)
                 except ParseError as e:
                     raise ParseError(f"failed to track a member"
                                      f" {mtype.tag} '{mname}' {str(e)}")
@@ -459,20 +1992,20 @@ class TypeDG:
                 else:
                     members.append(f"\t{self.gen_decl(mtype, mname)};"
                                    f"\t/* {', '.join(notes)} */");
-            print(f"\n/* GOFF0x{node.offset:x} @ {node.src_location()} */")
+            self.out.print(f"\n/* GOFF0x{node.offset:x} @ {node.src_location()} */")
             notes = []
             if not node.byte_size is None:
                 notes.append(f"size=0x{node.byte_size:x}")
-            print(f"{self.gen_decl(node)} {{" +
-                  (f"\t/* {' '.join(notes)} */" if notes else ""))
+            self.out.print(f"{self.gen_decl(node)} {{" +
+                           (f"\t/* {' '.join(notes)} */" if notes else ""))
             if members:
                 for line in members:
-                    print(line)
+                    self.out.print(line)
             elif not node.byte_size is None:
                 # dtrace may not allow C99 arrays
                 size = node.byte_size if node.byte_size > 0 else 1
-                print(f"\tchar dummy[0x{size:x}];")
-            print("};")
+                self.out.print(f"\tchar dummy[0x{size:x}];")
+            self.out.print("};")
             shown[key] = "defined"
             return
 
@@ -498,24 +2031,1284 @@ class TypeDG:
                 if vlen >= self.CTF_MAX_VLEN:
                     warn = f"reached CTF_MAX_VLEN {vlen}"
                     break
-            print(f"\n/* GOFF0x{node.offset:x} @ {node.src_location()} */")
-            print(self.gen_decl(node) + " {")
-            print(",\n".join(members))
+            self.out.print(f"\n/* GOFF0x{node.offset:x} @ {node.src_location()} */")
+            self.out.print(self.gen_decl(node) + " {")
+            self.out.print(",\n".join(members))
             if not warn is None :
-                print(f"\t/* {warn} */")
-            print("};")
+                self.out.print(f"\t/* {warn} */")
+            self.out.print("};")
             shown[key] = "defined"
             return
 
         raise ParseError("incompatible tag: " + node.tag)
 
+def read_uleb128(data, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def read_sleb128(data, pos: int):
+    value, end = read_uleb128(data, pos)
+    bits = 7 * (end - pos)
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value, end
+
+
+def lookup_debug_names(efile, name: str) -> list:
+    # DWARF 5 name index; returns the DIE offsets indexed under name
+    section = efile.get_section_by_name(".debug_names")
+    if section is None:
+        return []
+    strtab = efile.get_section_by_name(".debug_str")
+    strs = strtab.data() if strtab else b""
+    data = section.data()
+    endian = "<" if efile.little_endian else ">"
+    key = name.encode(ENCODING)
+    djb = 5381
+    for c in key:
+        djb = (djb * 33 + c) & 0xffffffff
+    FORMS = {0x0b: "B", 0x05: "H", 0x06: "I", 0x07: "Q",
+             0x11: "B", 0x12: "H", 0x13: "I", 0x14: "Q"}
+    DW_FORM_flag_present = 0x19
+    DW_IDX_compile_unit, DW_IDX_type_unit, DW_IDX_die_offset = 1, 2, 3
+    found = []
+    pos = 0
+    while pos + 4 <= len(data):
+        (length,) = struct.unpack_from(endian + "I", data, pos)
+        pos += 4
+        offfmt = "I"
+        if length == 0xffffffff:
+            (length,) = struct.unpack_from(endian + "Q", data, pos)
+            pos += 8
+            offfmt = "Q"
+        end = pos + length
+        (version, _, cu_count, ltu_count, ftu_count, bucket_count,
+         name_count, abbrev_size, aug_size) = struct.unpack_from(
+             endian + "HHIIIIIII", data, pos)
+        if version != 5:
+            raise ParseError(f"unknown .debug_names version {version}")
+        pos += 32 + aug_size
+        def array_at(fmt, count):
+            nonlocal pos
+            values = struct.unpack_from(f"{endian}{count}{fmt}", data, pos)
+            pos += struct.calcsize(f"{endian}{count}{fmt}")
+            return values
+        cus = array_at(offfmt, cu_count)
+        array_at(offfmt, ltu_count)
+        array_at("Q", ftu_count)
+        buckets = array_at("I", bucket_count)
+        hashes = array_at("I", name_count if bucket_count else 0)
+        str_offsets = array_at(offfmt, name_count)
+        entry_offsets = array_at(offfmt, name_count)
+        abbrevs = {}
+        apos = pos
+        while True:
+            code, apos = read_uleb128(data, apos)
+            if code == 0:
+                break
+            _, apos = read_uleb128(data, apos)
+            attrs = []
+            while True:
+                idx, apos = read_uleb128(data, apos)
+                form, apos = read_uleb128(data, apos)
+                if idx == 0 and form == 0:
+                    break
+                attrs.append((idx, form))
+            abbrevs[code] = attrs
+        pool = pos + abbrev_size
+        if bucket_count:
+            candidates = []
+            index = buckets[djb % bucket_count]
+            while 0 < index <= name_count:
+                h = hashes[index - 1]
+                if h % bucket_count != djb % bucket_count:
+                    break
+                if h == djb:
+                    candidates.append(index - 1)
+                index += 1
+        else:
+            candidates = range(name_count)
+        for i in candidates:
+            start = str_offsets[i]
+            if strs[start:start + len(key) + 1] != key + b"\0":
+                continue
+            epos = pool + entry_offsets[i]
+            while True:
+                code, epos = read_uleb128(data, epos)
+                if code == 0:
+                    break
+                cu_index = 0 if cu_count == 1 else None
+                die_offset = None
+                in_type_unit = False
+                for idx, form in abbrevs[code]:
+                    if form == DW_FORM_flag_present:
+                        value = True
+                    elif form in (0x0f, 0x15): # udata, ref_udata
+                        value, epos = read_uleb128(data, epos)
+                    elif form in FORMS:
+                        fmt = endian + FORMS[form]
+                        (value,) = struct.unpack_from(fmt, data, epos)
+                        epos += struct.calcsize(fmt)
+                    else:
+                        raise ParseError(f"cannot handle .debug_names"
+                                         f" form 0x{form:x} yet")
+                    if idx == DW_IDX_compile_unit:
+                        cu_index = value
+                    elif idx == DW_IDX_type_unit:
+                        in_type_unit = True
+                    elif idx == DW_IDX_die_offset:
+                        die_offset = value
+                if (in_type_unit or die_offset is None
+                    or cu_index is None or cu_index >= cu_count):
+                    continue
+                found.append(cus[cu_index] + die_offset)
+        pos = end
+    return found
+
+
+class FastDIE:
+    # just enough of elftools' DIE for register_die()
+    __slots__ = ("tag", "offset", "cu", "attributes", "children")
+
+    def __init__(self, tag, offset: int, cu, attributes: dict):
+        self.tag = tag
+        self.offset = offset
+        self.cu = cu
+        self.attributes = attributes
+        self.children = []
+
+    def iter_children(self):
+        return iter(self.children)
+
+class FastAttribute:
+    __slots__ = ("form", "value")
+
+    def __init__(self, form: str, value):
+        self.form = form
+        self.value = value
+
+class FastDIEReader:
+    # walks .debug_info by the abbreviation tables and decodes only the
+    # attributes build_node() reads; everything else is skipped by size
+    WANTED = ("DW_AT_name", "DW_AT_type", "DW_AT_declaration",
+              "DW_AT_decl_file", "DW_AT_decl_line", "DW_AT_byte_size",
+              "DW_AT_data_member_location", "DW_AT_bit_size",
+              "DW_AT_bit_offset", "DW_AT_data_bit_offset", "DW_AT_count",
+              "DW_AT_const_value", "DW_AT_sibling")
+    FIXED_SIZES = {
+        "DW_FORM_flag_present": 0, "DW_FORM_implicit_const": 0,
+        "DW_FORM_data1": 1, "DW_FORM_ref1": 1, "DW_FORM_flag": 1,
+        "DW_FORM_strx1": 1, "DW_FORM_addrx1": 1,
+        "DW_FORM_data2": 2, "DW_FORM_ref2": 2,
+        "DW_FORM_strx2": 2, "DW_FORM_addrx2": 2,
+        "DW_FORM_strx3": 3, "DW_FORM_addrx3": 3,
+        "DW_FORM_data4": 4, "DW_FORM_ref4": 4, "DW_FORM_ref_sup4": 4,
+        "DW_FORM_strx4": 4, "DW_FORM_addrx4": 4,
+        "DW_FORM_data8": 8, "DW_FORM_ref8": 8, "DW_FORM_ref_sig8": 8,
+        "DW_FORM_ref_sup8": 8, "DW_FORM_data16": 16,
+    }
+    OFFSET_FORMS = {"DW_FORM_strp", "DW_FORM_line_strp", "DW_FORM_sec_offset",
+                    "DW_FORM_strp_sup", "DW_FORM_GNU_ref_alt",
+                    "DW_FORM_GNU_strp_alt"}
+    LEB_FORMS = {"DW_FORM_udata", "DW_FORM_ref_udata", "DW_FORM_strx",
+                 "DW_FORM_addrx", "DW_FORM_loclistx", "DW_FORM_rnglistx",
+                 "DW_FORM_GNU_addr_index", "DW_FORM_GNU_str_index"}
+    UNSIGNED = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+    def __init__(self, dwinfo, pruned: Iterable[str] = ()):
+        from elftools.dwarf import enums
+        self.pruned = set(pruned)
+        def names(enum):
+            return {v: k for k, v in enum.items() if isinstance(v, int)}
+        self.tag_names = names(enums.ENUM_DW_TAG)
+        self.attr_names = names(enums.ENUM_DW_AT)
+        self.form_names = names(enums.ENUM_DW_FORM)
+        self.info = dwinfo.debug_info_sec.stream.getvalue()
+        self.abbrev = dwinfo.debug_abbrev_sec.stream.getvalue()
+        self.str = (dwinfo.debug_str_sec.stream.getvalue()
+                    if dwinfo.debug_str_sec else b"")
+        self.endian = "<" if dwinfo.config.little_endian else ">"
+        self.abbrev_tables = {}
+
+    def abbrev_table(self, offset: int) -> dict:
+        table = self.abbrev_tables.get(offset)
+        if table is not None:
+            return table
+        table = {}
+        data = self.abbrev
+        pos = offset
+        while True:
+            code, pos = read_uleb128(data, pos)
+            if code == 0:
+                break
+            tag, pos = read_uleb128(data, pos)
+            has_children = data[pos]
+            pos += 1
+            specs = []
+            while True:
+                attr, pos = read_uleb128(data, pos)
+                form, pos = read_uleb128(data, pos)
+                if attr == 0 and form == 0:
+                    break
+                implicit = None
+                if form == 0x21: # DW_FORM_implicit_const
+                    implicit, pos = read_sleb128(data, pos)
+                name = self.attr_names.get(attr, attr)
+                specs.append((name if name in self.WANTED else None,
+                              self.form_names.get(form, form), implicit))
+            table[code] = (sys.intern(self.tag_names.get(tag, tag)),
+                           bool(has_children), specs)
+        self.abbrev_tables[offset] = table
+        return table
+
+    def read_unit(self, CU) -> FastDIE:
+        # returns the top DIE with the whole tree below it
+        data = self.info
+        endian = self.endian
+        offset_size = 8 if CU.dwarf_format() == 64 else 4
+        address_size = CU['address_size']
+        ref_addr_size = address_size if CU['version'] <= 2 else offset_size
+        table = self.abbrev_table(CU['debug_abbrev_offset'])
+        def uint(pos, size):
+            return struct.unpack_from(endian + self.UNSIGNED[size],
+                                      data, pos)[0]
+        def read_form(form, pos, implicit, want):
+            # returns (value, next position); value only when wanted
+            size = self.FIXED_SIZES.get(form)
+            if size is not None:
+                if not want:
+                    return None, pos + size
+                if form == "DW_FORM_implicit_const":
+                    return implicit, pos
+                if form == "DW_FORM_flag_present":
+                    return True, pos
+                if size in self.UNSIGNED:
+                    return uint(pos, size), pos + size
+                return data[pos:pos + size], pos + size
+            if form in self.OFFSET_FORMS:
+                value = uint(pos, offset_size) if want else None
+                if want and form == "DW_FORM_strp":
+                    value = self.str[value:self.str.index(b"\0", value)]
+                return value, pos + offset_size
+            if form in self.LEB_FORMS:
+                return read_uleb128(data, pos)
+            if form == "DW_FORM_sdata":
+                return read_sleb128(data, pos)
+            if form == "DW_FORM_addr":
+                value = uint(pos, address_size) if want else None
+                return value, pos + address_size
+            if form == "DW_FORM_ref_addr":
+                value = uint(pos, ref_addr_size) if want else None
+                return value, pos + ref_addr_size
+            if form == "DW_FORM_string":
+                end = data.index(b"\0", pos)
+                return data[pos:end], end + 1
+            if form in ("DW_FORM_block1", "DW_FORM_block2",
+                        "DW_FORM_block4", "DW_FORM_block",
+                        "DW_FORM_exprloc"):
+                if form == "DW_FORM_block1":
+                    length, pos = data[pos], pos + 1
+                elif form == "DW_FORM_block2":
+                    length, pos = uint(pos, 2), pos + 2
+                elif form == "DW_FORM_block4":
+                    length, pos = uint(pos, 4), pos + 4
+                else:
+                    length, pos = read_uleb128(data, pos)
+                return list(data[pos:pos + length]), pos + length
+            if form == "DW_FORM_indirect":
+                form, pos = read_uleb128(data, pos)
+                return read_form(self.form_names.get(form, form), pos,
+                                 implicit, want)
+            raise ParseError(f"unknown form {form} in CU"
+                             f" GOFF0x{CU.cu_offset:x}")
+        pos = CU.cu_die_offset
+        end = CU.cu_offset + CU.size
+        top = None
+        parents = []
+        pruned = self.pruned
+        while pos < end:
+            die_offset = pos
+            code, pos = read_uleb128(data, pos)
+            if code == 0:
+                if parents:
+                    parents.pop()
+                continue
+            tag, has_children, specs = table[code]
+            attributes = {}
+            for name, form, implicit in specs:
+                if form == "DW_FORM_indirect":
+                    real, _ = read_uleb128(data, pos)
+                    form_name = self.form_names.get(real, real)
+                else:
+                    form_name = form
+                value, pos = read_form(form, pos, implicit, name is not None)
+                if name is not None:
+                    attributes[name] = FastAttribute(form_name, value)
+            die = FastDIE(tag, die_offset, CU, attributes)
+            if tag in pruned and parents:
+                if not has_children:
+                    continue
+                sibling = attributes.get("DW_AT_sibling")
+                if sibling is not None:
+                    pos = sibling.value
+                    if sibling.form != "DW_FORM_ref_addr":
+                        pos += CU.cu_offset
+                    continue
+                die = FastDIE(tag, die_offset, CU, {}) # read, then dropped
+            elif parents:
+                parents[-1].children.append(die)
+            elif top is None:
+                top = die
+            else:
+                break # past the unit's single top DIE
+            if has_children:
+                parents.append(die)
+        return top
+
+
+def get_build_id(f) -> Optional[str]:
+    import elftools.elf.elffile
+    efile = elftools.elf.elffile.ELFFile(f)
+    for section in efile.iter_sections():
+        if section['sh_type'] != 'SHT_NOTE':
+            continue
+        for note in section.iter_notes():
+            if note['n_type'] == 'NT_GNU_BUILD_ID':
+                return note['n_desc']
+    return None
+
+
+class MappedFile(mmap.mmap):
+    # read-only mapping usable wherever a binary file object is; pages of
+    # the (possibly huge) debug file are only brought in when touched
+    name = None
+
+def open_elf(path: str):
+    with open(path, 'rb') as f:
+        try:
+            m = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError): # empty file, pipe, ...
+            return open(path, 'rb')
+    m.name = path
+    return m
+
+
+BTF_MAGIC = (b"\x9f\xeb", b"\xeb\x9f")
+
+def is_raw_btf(f) -> bool:
+    # e.g. /sys/kernel/btf/vmlinux
+    f.seek(0)
+    magic = f.read(2)
+    f.seek(0)
+    return magic in BTF_MAGIC
+
+def read_btf_section(f) -> Optional[bytes]:
+    if is_raw_btf(f):
+        data = f.read()
+        f.seek(0)
+        return data
+    import elftools.elf.elffile
+    section = elftools.elf.elffile.ELFFile(f).get_section_by_name(".BTF")
+    if section is None or section['sh_type'] == 'SHT_NOBITS':
+        return None
+    return section.data()
+
+
+DEBUG_DIRS = ["/usr/lib/debug"]
+
+def find_debug_file(path: str, debug_dirs: Iterable[str] = DEBUG_DIRS,
+                    btf: Optional[bool] = None) -> str:
+    # a stripped binary refers to its DWARF by build-id or .gnu_debuglink;
+    # anything that carries .debug_info (or .BTF, unless DWARF is forced)
+    # itself is used as is
+    import elftools.elf.elffile
+    with open_elf(path) as f:
+        if is_raw_btf(f):
+            return path
+        efile = elftools.elf.elffile.ELFFile(f)
+        if efile.get_section_by_name(".debug_info") is not None:
+            return path
+        if not btf is False and read_btf_section(f) is not None:
+            return path
+        build_id = get_build_id(f)
+        link = efile.get_section_by_name(".gnu_debuglink")
+        link_name = None
+        if link is not None:
+            link_name = link.data().split(b"\0", 1)[0].decode(ENCODING)
+    candidates = []
+    if build_id:
+        candidates += [os.path.join(d, ".build-id", build_id[:2],
+                                    build_id[2:] + ".debug")
+                       for d in debug_dirs]
+    if link_name:
+        here = os.path.dirname(os.path.abspath(path))
+        candidates += [os.path.join(here, link_name),
+                       os.path.join(here, ".debug", link_name)]
+        candidates += [os.path.join(d, here.lstrip(os.sep), link_name)
+                       for d in debug_dirs]
+    for candidate in candidates:
+        if not os.path.isfile(candidate) or os.path.samefile(candidate, path):
+            continue
+        if build_id:
+            with open_elf(candidate) as f:
+                if get_build_id(f) != build_id:
+                    continue
+        return candidate
+    return path
+
+
+_tool_digest = None
+
+def tool_digest() -> str:
+    # stands for the version of this script
+    global _tool_digest
+    if _tool_digest is None:
+        import hashlib
+        with open(__file__, 'rb') as f:
+            _tool_digest = hashlib.sha256(f.read()).hexdigest()
+    return _tool_digest
+
+
+class TypeCache:
+    MAGIC = b"D2DTGRPH"
+    FORMAT_VERSION = 1
+    header = struct.Struct("<8sI")
+    fields = tuple(field.name for field in dataclasses.fields(Node))
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key_for(self, f, **options) -> str:
+        import hashlib
+        build_id = get_build_id(f)
+        if build_id:
+            key = "buildid-" + build_id
+        else:
+            digest = hashlib.sha256()
+            f.seek(0)
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+            f.seek(0)
+            key = "sha256-" + digest.hexdigest()
+        # a graph parsed by another version of this script or with other
+        # parse options is a different entry
+        variant = hashlib.sha256(tool_digest().encode(ENCODING))
+        for name in sorted(options):
+            variant.update(f"\0{name}={options[name]!r}".encode(ENCODING))
+        return f"{key}-{variant.hexdigest()[:16]}"
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".d2d")
+
+    def load(self, key: str):
+        import marshal
+        import zlib
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                magic, version = self.header.unpack(f.read(self.header.size))
+                if magic != self.MAGIC or version != self.FORMAT_VERSION:
+                    raise ValueError(f"unknown format {magic} v{version}")
+                log, rows = marshal.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError, struct.error,
+                zlib.error) as e:
+            print(f"dwarf2dtrace: dropping cache {path}: {e}",
+                  file=sys.stderr)
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            return None
+        os.utime(path) # for LRU eviction
+        offset_to_node = {}
+        for row in rows:
+            node = Node(*row)
+            offset_to_node[node.offset] = node
+        return offset_to_node, log
+
+    def store(self, key: str, offset_to_node: Dict[int, Node], log: str):
+        import marshal
+        import tempfile
+        import zlib
+        def plain(value):
+            # marshal only takes builtin types, not construct containers
+            if isinstance(value, list):
+                return list(value)
+            return value
+        rows = [tuple(plain(getattr(node, name)) for name in self.fields)
+                for node in offset_to_node.values()]
+        data = zlib.compress(marshal.dumps((log, rows)), 1)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.header.pack(self.MAGIC, self.FORMAT_VERSION))
+                f.write(data)
+            os.replace(tmp, self.path_for(key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".d2d"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total -= size
+
+
+class CTFWriter:
+    # CTF version 2 container as loaded by DTrace (sys/ctf.h)
+    MAGIC = 0xcff1
+    VERSION = 2
+    F_COMPRESS = 0x1
+    MAX_PTYPE = 0x7fff
+    MAX_SIZE = 0xfffe
+    LSIZE_SENT = 0xffff
+    LSTRUCT_THRESH = 8192
+    (K_UNKNOWN, K_INTEGER, K_FLOAT, K_POINTER, K_ARRAY, K_FUNCTION,
+     K_STRUCT, K_UNION, K_ENUM, K_FORWARD, K_TYPEDEF, K_VOLATILE,
+     K_CONST, K_RESTRICT) = range(14)
+    INT_SIGNED, INT_CHAR, INT_BOOL = 0x1, 0x2, 0x4
+    FP_SINGLE, FP_DOUBLE, FP_CPLX, FP_DCPLX, FP_LDCPLX, FP_LDOUBLE = range(1, 7)
+    header = struct.Struct("<HBBIIIIIIII")
+    KINDS = {
+        "DW_TAG_pointer_type": K_POINTER,
+        "DW_TAG_reference_type": K_POINTER,
+        "DW_TAG_rvalue_reference_type": K_POINTER,
+        "DW_TAG_const_type": K_CONST,
+        "DW_TAG_volatile_type": K_VOLATILE,
+        "DW_TAG_restrict_type": K_RESTRICT,
+        "DW_TAG_typedef": K_TYPEDEF,
+        "DW_TAG_array_type": K_ARRAY,
+        "DW_TAG_subroutine_type": K_FUNCTION,
+        "DW_TAG_structure_type": K_STRUCT,
+        "DW_TAG_class_type": K_STRUCT,
+        "DW_TAG_union_type": K_UNION,
+        "DW_TAG_enumeration_type": K_ENUM,
+    }
+
+    def __init__(self, dg: TypeDG, little_endian: bool = True):
+        self.dg = dg
+        self.little_endian = little_endian
+        self.strtab = bytearray(b"\0")
+        self.string_offsets = {"": 0}
+        self.ids = {} # goff or synthetic key -> type id
+        self.named = {} # (kind, name) -> type id, like 'shown'
+        self.forwards = {} # (kind, name) -> id of a K_FORWARD so far
+        self.count = 0
+        self.queue = collections.deque() # (type id, Node or encoding)
+        self.types = {} # type id -> encoding
+        self.warnings = {} # ordered set
+
+    def warn(self, message: str):
+        self.warnings[message] = None
+
+    def string(self, s: Optional[str]) -> int:
+        if not s:
+            return 0
+        offset = self.string_offsets.get(s)
+        if offset is None:
+            offset = len(self.strtab)
+            self.strtab += s.encode(ENCODING) + b"\0"
+            self.string_offsets[s] = offset
+        return offset
+
+    def allocate(self, key) -> int:
+        tid = self.count + 1
+        if tid > self.MAX_PTYPE:
+            raise ParseError(f"more than {self.MAX_PTYPE} CTF types")
+        self.ids[key] = tid
+        self.count = tid
+        return tid
+
+    def resolve(self, goff: Optional[int]) -> Optional[Node]:
+        # types DTrace predefines and _Atomic have no CTF counterpart,
+        # so references go to what they stand for
+        seen = set()
+        while goff is not None and not goff in seen:
+            seen.add(goff)
+            try:
+                node = self.dg.get_node(goff)
+            except ParseError as e:
+                self.warn(str(e))
+                return None
+            if node.tag == "DW_TAG_atomic_type":
+                goff = node.type_goff
+                continue
+            if node.tag == "DW_TAG_typedef" and (
+                    node.nickname in self.dg.PREDEFINED_TYPES
+                    or node.nickname.startswith("__builtin")):
+                goff = node.type_goff
+                continue
+            return node
+        return None
+
+    def children(self, node: Node) -> list:
+        children = []
+        for goff in node.deps or ():
+            try:
+                children.append(self.dg.get_node(goff))
+            except ParseError as e:
+                self.warn(str(e))
+        return children
+
+    def type_id(self, goff: Optional[int]) -> int:
+        node = self.resolve(goff)
+        if node is None:
+            return 0
+        tid = self.ids.get(node.offset)
+        if tid is not None:
+            return tid
+        kind = self.KINDS.get(node.tag)
+        if not (kind in (self.K_STRUCT, self.K_UNION, self.K_ENUM,
+                         self.K_TYPEDEF) and node.name):
+            tid = self.allocate(node.offset)
+            self.queue.append((tid, node))
+            return tid
+        key = (kind, node.name)
+        tid = self.named.get(key)
+        if tid is None and self.is_forward(node):
+            tid = self.forwards.get(key)
+            if tid is None:
+                tid = self.allocate(node.offset)
+                self.forwards[key] = tid
+                self.queue.append((tid, node))
+            self.ids[node.offset] = tid
+            return tid
+        if tid is None:
+            # a definition takes over the id its forward declaration got
+            tid = self.forwards.pop(key, None)
+            if tid is None:
+                tid = self.allocate(node.offset)
+            self.named[key] = tid
+            self.queue.append((tid, node))
+        self.ids[node.offset] = tid
+        return tid
+
+    def is_forward(self, node: Node) -> bool:
+        return (self.KINDS.get(node.tag) in (self.K_STRUCT, self.K_UNION)
+                and (node.is_decl or node.byte_size is None))
+
+    def synthetic(self, key, encoded: bytes) -> int:
+        tid = self.ids.get(key)
+        if tid is None:
+            tid = self.allocate(key)
+            self.queue.append((tid, encoded))
+        return tid
+
+    def int_encoding(self, name: str) -> int:
+        encoding = 0
+        if "bool" in name.lower():
+            encoding = self.INT_BOOL
+        elif not "unsigned" in name:
+            encoding = self.INT_SIGNED
+        if "char" in name:
+            encoding |= self.INT_CHAR
+        return encoding
+
+    def int_type(self, name: str, byte_size: int, bits: int = None,
+                 isroot: bool = True) -> int:
+        if bits is None:
+            bits = byte_size * 8
+        data = struct.pack("<I", (self.int_encoding(name) << 24) | bits)
+        return self.synthetic(("int", name, bits, isroot),
+                              self.stype(name, self.K_INTEGER, 0,
+                                         byte_size, isroot) + data)
+
+    def stype(self, name: Optional[str], kind: int, vlen: int,
+              size_or_type: int, isroot: bool = True) -> bytes:
+        info = (kind << 11) | (int(isroot) << 10) | vlen
+        if size_or_type > self.MAX_SIZE:
+            return struct.pack("<IHHII", self.string(name), info,
+                               self.LSIZE_SENT, size_or_type >> 32,
+                               size_or_type & 0xffffffff)
+        return struct.pack("<IHH", self.string(name), info, size_or_type)
+
+    def vlen(self, node: Node, count: int) -> int:
+        if count > self.dg.CTF_MAX_VLEN:
+            self.warn(f"GOFF0x{node.offset:x} {node.nickname}:"
+                                 f" reached CTF_MAX_VLEN {self.dg.CTF_MAX_VLEN}")
+            return self.dg.CTF_MAX_VLEN
+        return count
+
+    def storage_size(self, mtype: Optional[Node]) -> int:
+        # the size of a bitfield's type, looked up through typedefs and
+        # qualifiers that carry none themselves
+        seen = set()
+        while (mtype is not None and mtype.byte_size is None
+               and not mtype.offset in seen
+               and (mtype.tag == "DW_TAG_typedef"
+                    or mtype.tag in self.dg.TAGS_for_qualifiers)):
+            seen.add(mtype.offset)
+            try:
+                mtype = self.dg.get_node(mtype.type_goff)
+            except ParseError:
+                return 0
+        return (mtype.byte_size if mtype else None) or 0
+
+    def member_bit_offset(self, child: Node, mtype: Optional[Node]) -> int:
+        mloc = child.data_member_location
+        if isinstance(mloc, list):
+            # DW_OP_plus_uconst N
+            mloc = read_uleb128(mloc, 1)[0] if mloc and mloc[0] == 0x23 else 0
+        if mloc is None:
+            mloc = 0
+        if child.bit_size is None or child.bit_offset is None:
+            return mloc * 8
+        # DW_AT_bit_offset counts from the most significant bit
+        storage = child.byte_size or self.storage_size(mtype)
+        if not self.little_endian:
+            return mloc * 8 + child.bit_offset
+        return mloc * 8 + storage * 8 - child.bit_offset - child.bit_size
+
+    def encode(self, node: Node) -> bytes:
+        dg = self.dg
+        tag = node.tag
+        if tag == "DW_TAG_base_type":
+            name = node.name or ""
+            size = node.byte_size or 0
+            if "float" in name or "double" in name:
+                if "complex" in name:
+                    fp = {8: self.FP_CPLX, 16: self.FP_DCPLX}.get(
+                        size, self.FP_LDCPLX)
+                else:
+                    fp = {4: self.FP_SINGLE, 8: self.FP_DOUBLE}.get(
+                        size, self.FP_LDOUBLE)
+                return (self.stype(name, self.K_FLOAT, 0, size)
+                        + struct.pack("<I", (fp << 24) | (size * 8)))
+            return (self.stype(name, self.K_INTEGER, 0, size)
+                    + struct.pack("<I", (self.int_encoding(name) << 24)
+                                  | (size * 8)))
+        kind = self.KINDS.get(tag)
+        if kind in (self.K_POINTER, self.K_CONST, self.K_VOLATILE,
+                    self.K_RESTRICT):
+            return self.stype(None, kind, 0, self.type_id(node.type_goff))
+        if kind == self.K_TYPEDEF:
+            return self.stype(node.name, kind, 0, self.type_id(node.type_goff))
+        if kind == self.K_ARRAY:
+            index = self.int_type("long int", 8)
+            # same as the header, which cannot say [] or [0] either
+            nelems = node.quantity if node.quantity and node.quantity > 0 else 1
+            return (self.stype(None, kind, 0, 0)
+                    + struct.pack("<HHI", self.type_id(node.type_goff),
+                                  index, nelems))
+        if kind == self.K_FUNCTION:
+            args = self.children(node)
+            vlen = self.vlen(node, len(args))
+            data = self.stype(None, kind, vlen, self.type_id(node.type_goff))
+            data += struct.pack(f"<{vlen}H", *(self.type_id(arg.type_goff)
+                                              for arg in args[:vlen]))
+            if vlen % 2:
+                data += b"\0\0"
+            return data
+        if kind in (self.K_STRUCT, self.K_UNION):
+            if self.is_forward(node):
+                return self.stype(node.name, self.K_FORWARD, 0, 0)
+            members = self.children(node)
+            vlen = self.vlen(node, len(members))
+            data = self.stype(node.name, kind, vlen, node.byte_size)
+            for child in members[:vlen]:
+                mtype = self.resolve(child.type_goff)
+                if child.bit_size is None:
+                    tid = self.type_id(child.type_goff)
+                else:
+                    base = mtype.name if mtype and mtype.name else "int"
+                    tid = self.int_type(base, mtype.byte_size if mtype and
+                                        mtype.byte_size else 4,
+                                        child.bit_size, isroot=False)
+                offset = self.member_bit_offset(child, mtype)
+                if node.byte_size >= self.LSTRUCT_THRESH:
+                    data += struct.pack("<IHHII", self.string(child.name),
+                                        tid, 0, offset >> 32,
+                                        offset & 0xffffffff)
+                else:
+                    data += struct.pack("<IHH", self.string(child.name),
+                                        tid, offset)
+            return data
+        if kind == self.K_ENUM:
+            enumerators = self.children(node)
+            vlen = self.vlen(node, len(enumerators))
+            data = self.stype(node.name, kind, vlen, node.byte_size or 4)
+            for child in enumerators[:vlen]:
+                value = child.quantity or 0
+                if value > 0x7FFFFFFF:
+                    # same squeeze as the C header
+                    value -= 0x80000000
+                value = (value + (1 << 31)) % (1 << 32) - (1 << 31)
+                data += struct.pack("<Ii", self.string(child.name), value)
+            return data
+        self.warn(f"GOFF0x{node.offset:x}: no CTF kind for {tag}")
+        return self.stype(node.name, self.K_UNKNOWN, 0, 0)
+
+    def add(self, roots: Iterable[Node]):
+        for node in roots:
+            if node.tag == "DW_TAG_subprogram":
+                continue # functions belong to the symbol-indexed section
+            self.type_id(node.offset)
+            while self.queue:
+                tid, item = self.queue.popleft()
+                if isinstance(item, Node):
+                    item = self.encode(item)
+                self.types[tid] = item
+
+    def getvalue(self, compress: bool = True) -> bytes:
+        import zlib
+        types = b"".join(self.types[tid] for tid in sorted(self.types))
+        body = types + bytes(self.strtab)
+        flags = 0
+        if compress:
+            body = zlib.compress(body)
+            flags |= self.F_COMPRESS
+        # no labels, objects or functions: those sections are empty
+        return self.header.pack(self.MAGIC, self.VERSION, flags,
+                                0, 0, 0, 0, 0, 0,
+                                len(types), len(self.strtab)) + body
+
+
+def read_ctf(data: bytes) -> Dict[int, dict]:
+    # minimal reader for what CTFWriter produces
+    import zlib
+    W = CTFWriter
+    (magic, version, flags, _, _, _, _, _, typeoff, stroff,
+     strlen) = W.header.unpack_from(data)
+    if magic != W.MAGIC or version != W.VERSION:
+        raise ParseError(f"not a CTF v2 container: 0x{magic:x} v{version}")
+    body = data[W.header.size:]
+    if flags & W.F_COMPRESS:
+        body = zlib.decompress(body)
+    strtab = body[stroff:stroff + strlen]
+    def string(offset):
+        return strtab[offset:strtab.index(b"\0", offset)].decode(ENCODING)
+    types = {}
+    pos = typeoff
+    tid = 1
+    while pos < stroff:
+        name, info, size = struct.unpack_from("<IHH", body, pos)
+        pos += 8
+        kind, isroot, vlen = info >> 11, (info >> 10) & 1, info & 0x3ff
+        if size == W.LSIZE_SENT:
+            hi, lo = struct.unpack_from("<II", body, pos)
+            pos += 8
+            size = (hi << 32) | lo
+        t = {"kind": kind, "name": string(name), "isroot": bool(isroot),
+             "vlen": vlen}
+        if kind in (W.K_POINTER, W.K_TYPEDEF, W.K_VOLATILE, W.K_CONST,
+                    W.K_RESTRICT, W.K_FUNCTION):
+            t["type"] = size
+        else:
+            t["size"] = size
+        if kind in (W.K_INTEGER, W.K_FLOAT):
+            (encoding,) = struct.unpack_from("<I", body, pos)
+            pos += 4
+            t["encoding"] = encoding >> 24
+            t["bits"] = encoding & 0xffff
+        elif kind == W.K_ARRAY:
+            t["contents"], t["index"], t["nelems"] = struct.unpack_from(
+                "<HHI", body, pos)
+            pos += 8
+        elif kind == W.K_FUNCTION:
+            t["args"] = list(struct.unpack_from(f"<{vlen}H", body, pos))
+            pos += 2 * (vlen + vlen % 2)
+        elif kind in (W.K_STRUCT, W.K_UNION):
+            members = []
+            for _ in range(vlen):
+                if size >= W.LSTRUCT_THRESH:
+                    mname, mtype, _, hi, lo = struct.unpack_from(
+                        "<IHHII", body, pos)
+                    pos += 16
+                    offset = (hi << 32) | lo
+                else:
+                    mname, mtype, offset = struct.unpack_from("<IHH", body, pos)
+                    pos += 8
+                members.append((string(mname), mtype, offset))
+            t["members"] = members
+        elif kind == W.K_ENUM:
+            enumerators = []
+            for _ in range(vlen):
+                ename, value = struct.unpack_from("<Ii", body, pos)
+                pos += 8
+                enumerators.append((string(ename), value))
+            t["enumerators"] = enumerators
+        types[tid] = t
+        tid += 1
+    return types
+
+
+class TypeServer:
+    # answers one JSON object per line, {"elf": PATH, "types": [NAME...]},
+    # with {"header": TEXT} or {"error": MESSAGE}; graphs are loaded once
+    # and every request starts from an empty shown/reserved state. besides
+    # the files loaded at startup, only files under 'dirs' are loaded
+    def __init__(self, load: Callable[[str], TypeDG],
+                 dirs: Iterable[str] = ()):
+        self.load = load
+        self.graphs = {} # realpath -> (TypeDG, name index)
+        self.dirs = [os.path.realpath(d) for d in dirs]
+
+    def allowed(self, key: str) -> bool:
+        return any(os.path.commonpath([key, d]) == d for d in self.dirs)
+
+    def graph(self, path: str, startup: bool = False):
+        key = os.path.realpath(path)
+        graph = self.graphs.get(key)
+        if graph is None:
+            if not (startup or self.allowed(key)):
+                raise ParseError(f"{path}: not served (see --serve-dir)")
+            dg = self.load(key)
+            graph = (dg, dg.name_index())
+            self.graphs[key] = graph
+        return graph
+
+    def answer(self, request: dict) -> dict:
+        from elftools.common.exceptions import ELFError, DWARFError
+        try:
+            types = request["types"]
+            if not (isinstance(types, list)
+                    and all(isinstance(name, str) for name in types)):
+                raise TypeError("\"types\" must be a list of strings")
+            if not isinstance(request["elf"], str):
+                raise TypeError("\"elf\" must be a string")
+            dg, index = self.graph(request["elf"])
+            out = dg.out
+            dg.out = Emitter()
+            try:
+                roots = dg.find_roots(types, index)
+                notes = dg.out.getvalue()
+            finally:
+                dg.out = out
+            return {"header": notes + dg.render({}, None, roots)}
+        except (ParseError, ELFError, DWARFError, struct.error, OSError,
+                KeyError, TypeError, ValueError) as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def serve(self, socket_path: str):
+        import json
+        import socketserver
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = server.answer(json.loads(line))
+                    except ValueError as e:
+                        reply = {"error": f"bad request: {e}"}
+                    self.wfile.write(json.dumps(reply).encode(ENCODING)
+                                     + b"\n")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        with socketserver.UnixStreamServer(socket_path, Handler) as unix:
+            unix.serve_forever()
+
+
+def query(socket_path: str, elf: str, types: Iterable[str]) -> str:
+    import json
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        request = {"elf": os.path.abspath(elf), "types": list(types)}
+        sock.sendall(json.dumps(request).encode(ENCODING) + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as stream:
+            line = stream.readline()
+    if not line:
+        raise ParseError(f"{socket_path}: no reply from server")
+    try:
+        reply = json.loads(line)
+    except ValueError as e:
+        raise ParseError(f"{socket_path}: garbled reply: {e}") from None
+    if not isinstance(reply, dict):
+        raise ParseError(f"{socket_path}: garbled reply: {line[:80]!r}")
+    if "error" in reply:
+        raise ParseError(reply["error"])
+    if not isinstance(reply.get("header"), str):
+        raise ParseError(f"{socket_path}: garbled reply: no header")
+    return reply["header"]
+
+
+def _parse_elf(args):
+    path, verbose, with_stats, native_decoder, prune, btf = args
+    TypeDG.VERBOSE = verbose
+    dg = TypeDG()
+    dg.out = Emitter()
+    dg.native_decoder = native_decoder
+    dg.prune = prune
+    dg.btf = btf
+    if with_stats:
+        dg.stats = Stats()
+    with open_elf(path) as f:
+        dg.parse_file(f)
+    return dg.offset_to_node, dg.out.getvalue(), dg.stats
+
+
+def _parse_cu_chunk(args):
+    (path, cu_offsets, cu_filter, verbose, with_stats, native_decoder,
+     prune) = args
+    TypeDG.VERBOSE = verbose
+    dg = TypeDG()
+    dg.out = Emitter()
+    dg.native_decoder = native_decoder
+    dg.prune = prune
+    dg.btf = False # chunks of CUs only exist for DWARF
+    if with_stats:
+        dg.stats = Stats()
+    with open_elf(path) as f:
+        dg.parse_file(f, cu_filter, cu_offsets=cu_offsets)
+    return dg.offset_to_node, dg.out.getvalue(), dg.stats
+
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="generate a C header file for DTrace from DWARF")
+    parser.add_argument("elffile", nargs="+",
+                        help="several files share one deduplicated type pool")
+    parser.add_argument("--debug-dir", action="append", metavar="DIR",
+                        help="look up separate debug files under DIR"
+                        f" (default: {' '.join(DEBUG_DIRS)})")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the header to FILE instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="parse CUs in N worker processes"
+                        " (0: one per CPU)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--btf", action="store_true",
+                        help="read types from .BTF (default when present)")
+    source.add_argument("--dwarf", action="store_true",
+                        help="read types from DWARF even if .BTF is present")
+    parser.add_argument("--native-decoder", action="store_true",
+                        help="decode DIEs with the built-in reader that"
+                        " skips unused attributes")
+    parser.add_argument("--prune", action="store_true",
+                        help="skip variables, call sites and inlined code"
+                        " while walking CUs")
+    parser.add_argument("--compact-nodes", action="store_true",
+                        help="keep the type graph in typed columns: less"
+                        " memory on very large graphs, but slower")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse, emit and free one CU at a time to bound"
+                        " memory by the largest CU")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse the parsed type graph across runs")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="cache directory (implies --cache)")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+                        help="evict old cache entries beyond this size")
+    parser.add_argument("--dedup", action="store_true",
+                        help="merge structurally identical types across CUs")
+    parser.add_argument("-t", "--type", action="append", metavar="NAME",
+                        help="emit only NAME (e.g. 'struct proc') and the"
+                        " types it depends on; may be repeated")
+    parser.add_argument("--for-script", metavar="SCRIPT",
+                        help="emit only the types the D script SCRIPT"
+                        " refers to and the types they depend on")
+    parser.add_argument("--split", metavar="DIR",
+                        help="with several ELF files, write the types they"
+                        " share to DIR/base.h and the rest to one header"
+                        " per file")
+    parser.add_argument("--shard", metavar="DIR",
+                        help="write one header per source directory to DIR,"
+                        " rewriting only those that changed")
+    parser.add_argument("--ctf", metavar="FILE",
+                        help="also write the types as a CTF container")
+    parser.add_argument("--stats", action="store_true",
+                        help="report timings and counters as JSON on stderr")
+    parser.add_argument("--stats-file", metavar="FILE",
+                        help="write the --stats report to FILE instead")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="keep the ELF files' types in memory and answer"
+                        " requests on the Unix socket SOCKET")
+    parser.add_argument("--serve-dir", action="append", metavar="DIR",
+                        help="let --serve also load ELF files under DIR on"
+                        " request (default: only the ELFFILEs given)")
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help="ask the server at SOCKET for the -t types")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="write per-type hashes and text to FILE")
+    parser.add_argument("--since", metavar="FILE",
+                        help="emit only types added or changed since the"
+                        " build that wrote the manifest FILE (not a complete"
+                        " header on its own)")
+    args = parser.parse_args()
+    if args.jobs <= 0:
+        args.jobs = os.cpu_count() or 1
+    cache = None
+    if args.cache or args.cache_dir:
+        cache_dir = args.cache_dir or os.path.join(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.path.expanduser("~/.cache"), "dwarf2dtrace")
+        cache = TypeCache(cache_dir, args.cache_size << 20)
+    debug_dirs = args.debug_dir or DEBUG_DIRS
+    btf = True if args.btf else False if args.dwarf else None
+    if args.connect:
+        if len(args.elffile) != 1 or not args.type:
+            parser.error("--connect takes one ELF file and -t")
+        try:
+            header = query(args.connect, args.elffile[0], args.type)
+        except (OSError, ParseError) as e:
+            sys.exit(f"dwarf2dtrace: {e}")
+        with open(args.output or sys.stdout.fileno(), 'w', encoding=ENCODING,
+                  closefd=bool(args.output)) as sink:
+            sink.write(header)
+        sys.exit(0)
+    if args.serve:
+        def load(path):
+            dg = TypeDG()
+            dg.out = Emitter() # parse diagnostics are not served
+            dg.native_decoder = args.native_decoder
+            dg.prune = args.prune
+            dg.btf = btf
+            dg.compact = args.compact_nodes
+            dg.offset_to_node = dg.new_store()
+            with open_elf(find_debug_file(path, debug_dirs, btf)) as f:
+                if cache:
+                    dg.parse_file_cached(f, cache, jobs=args.jobs)
+                else:
+                    dg.parse_file(f, jobs=args.jobs)
+            if args.dedup:
+                dg.dedup()
+            return dg
+        server = TypeServer(load, args.serve_dir or ())
+        for path in args.elffile:
+            server.graph(path, startup=True)
+        server.serve(args.serve)
+        sys.exit(0)
+    previous = None
+    if args.since:
+        import json
+        try:
+            with open(args.since, encoding=ENCODING) as m:
+                previous = json.load(m)
+            TypeDG.check_manifest(previous)
+        except (OSError, ValueError, ParseError) as e:
+            parser.error(f"--since {args.since}: {e}")
+    paths = [find_debug_file(path, debug_dirs, btf) for path in args.elffile]
+    for path in paths if btf else ():
+        with open_elf(path) as f:
+            if read_btf_section(f) is None:
+                parser.error(f"--btf: no .BTF section in {path}")
+    if len(paths) > 1 and (cache or args.manifest or args.since):
+        parser.error("--cache, --manifest and --since take one ELF file")
+    if args.stream and (len(paths) > 1 or args.jobs > 1 or cache
+                        or args.dedup or args.type or args.for_script
+                        or args.manifest or args.since or args.ctf
+                        or args.shard):
+        parser.error("--stream takes one ELF file and none of -j, --cache,"
+                     " --dedup, -t, --for-script, --manifest, --since, --ctf,"
+                     " --shard")
+    if args.shard and (args.split or args.manifest or args.since):
+        parser.error("--shard cannot be combined with --split, --manifest"
+                     " or --since")
+    if args.split and (len(paths) < 2 or args.output or args.type
+                       or args.for_script):
+        parser.error("--split takes several ELF files and no -o, -t"
+                     " or --for-script")
+    script = None
+    if args.for_script:
+        with open(args.for_script, encoding=ENCODING) as f:
+            script = f.read()
     # sys.setrecursionlimit(100)
-    path = sys.argv[1]
-    with open(path, 'rb') as f:
+    with contextlib.ExitStack() as stack:
+        sink = stack.enter_context(
+            open(args.output or sys.stdout.fileno(), 'w', encoding=ENCODING,
+                 closefd=bool(args.output)))
         dg = TypeDG()
-        dg.parse_file(f)
+        dg.out = Emitter(sink)
+        if args.stats or args.stats_file:
+            dg.stats = Stats()
+        dg.native_decoder = args.native_decoder
+        dg.prune = args.prune
+        dg.btf = btf
+        dg.compact = args.compact_nodes
+        dg.offset_to_node = dg.new_store()
+        roots = None
+        if len(paths) > 1:
+            files = dg.parse_files(paths, jobs=args.jobs)
+            with dg.phase("dedup"):
+                remap = dg.dedup()
+            if not args.split:
+                for _, log in files:
+                    dg.out.write(log)
+            if args.type:
+                roots = dg.find_roots(args.type)
+            if script is not None:
+                roots = (roots or []) + dg.find_script_roots(script)
+        else:
+            f = stack.enter_context(open_elf(paths[0]))
+            if args.stream:
+                pass # parsed along with explain_streaming()
+            elif args.type and not (cache or args.dedup or script):
+                roots = dg.parse_lazily(f, args.type)
+            else:
+                if cache:
+                    dg.parse_file_cached(f, cache, jobs=args.jobs)
+                else:
+                    dg.parse_file(f, jobs=args.jobs)
+                if args.dedup:
+                    with dg.phase("dedup"):
+                        dg.dedup()
+                if args.type:
+                    roots = dg.find_roots(args.type)
+                if script is not None:
+                    roots = (roots or []) + dg.find_script_roots(script)
         def non_anon(node: Node):
             return not (node.name is None)
-        dg.explain({}, non_anon)
+        if args.stream:
+            dg.explain_streaming(f, non_anon)
+        elif args.split:
+            with dg.phase("explain"):
+                dg.explain_split(files, args.elffile, args.split, non_anon,
+                                 remap)
+        elif args.shard:
+            with dg.phase("explain"):
+                written = dg.explain_shards(args.shard, non_anon, roots)
+            for name in written:
+                dg.out.print(f"/* wrote {os.path.join(args.shard, name)}.h */")
+        elif args.manifest or args.since:
+            import json
+            with dg.phase("explain"):
+                manifest = dg.explain_incremental({}, non_anon, roots,
+                                                  previous)
+            if args.manifest:
+                with dg.phase("emission"), \
+                     open(args.manifest, 'w', encoding=ENCODING) as m:
+                    json.dump(manifest, m)
+        else:
+            with dg.phase("explain"):
+                dg.explain({}, non_anon, roots)
+        with dg.phase("emission"):
+            dg.out.flush()
+        if args.ctf:
+            with dg.phase("ctf"):
+                ctf = CTFWriter(dg)
+                ctf.add(dg.iter_roots(non_anon, roots))
+                data = ctf.getvalue()
+            for warning in ctf.warnings:
+                print(f"dwarf2dtrace: ctf: {warning}", file=sys.stderr)
+            with dg.phase("emission"), open(args.ctf, 'wb') as c:
+                c.write(data)
+    if dg.stats is not None:
+        import json
+        report = json.dumps(dg.stats.report(dg), indent=1)
+        if args.stats_file:
+            with open(args.stats_file, 'w', encoding=ENCODING) as m:
+                m.write(report + "\n")
+        else:
+            print(report, file=sys.stderr)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# regression tests; run with python -m pytest (or -m unittest). the tests
+# that compile fixtures are skipped without a C compiler
+import io
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import dwarf2dtrace
+from dwarf2dtrace import TypeDG, Emitter, Node, CTFWriter, read_ctf
+
+CC = os.environ.get("CC", "cc")
+
+
+def make_graph(entries) -> TypeDG:
+    # entries are (offset, tag, name, fields) in the order a CU walk
+    # would register them
+    dg = TypeDG()
+    dg.out = Emitter()
+    for offset, tag, name, fields in entries:
+        values = dict(tag=tag, offset=offset, name=name, nickname=name,
+                      type_goff=None, is_decl=False, decl_file="graph.h",
+                      decl_line=offset, data_member_location=None,
+                      byte_size=None, bit_size=None, bit_offset=None,
+                      deps=None, quantity=None)
+        values.update(fields)
+        dg.offset_to_node[offset] = Node(**values)
+    return dg
+
+
+def explain_text(dg: TypeDG, roots=None) -> str:
+    dg.explain({}, lambda node: node.name is not None, roots)
+    return dg.out.getvalue()
+
+
+def chain_and_cycle(depth: int) -> TypeDG:
+    # link_i holds link_i+1 by value; node_a points to node_b, which
+    # holds node_a by value
+    entries = [(1, "DW_TAG_base_type", "long", dict(byte_size=8)),
+               (50, "DW_TAG_structure_type", "node_a",
+                dict(byte_size=16, deps=(51,))),
+               (51, "DW_TAG_member", "b_ptr",
+                dict(type_goff=60, data_member_location=0)),
+               (60, "DW_TAG_pointer_type", None,
+                dict(type_goff=70, byte_size=8)),
+               (70, "DW_TAG_structure_type", "node_b",
+                dict(byte_size=16, deps=(71,))),
+               (71, "DW_TAG_member", "a_value",
+                dict(type_goff=50, data_member_location=0))]
+    for i in range(depth):
+        goff = 100 + 10 * i
+        entries += [
+            (goff, "DW_TAG_structure_type", f"link_{i}",
+             dict(byte_size=8 * (depth - i + 1), deps=(goff + 1, goff + 2))),
+            (goff + 1, "DW_TAG_member", "value",
+             dict(type_goff=1, data_member_location=0)),
+            (goff + 2, "DW_TAG_member", "next",
+             dict(type_goff=goff + 10 if i + 1 < depth else 1,
+                  data_member_location=8))]
+    return make_graph(entries)
+
+
+def expected_chain_and_cycle(depth: int) -> str:
+    # the order the recursive track() of the original script produced
+    text = """struct node_b;/* for GOFF0x32 node_a */
+
+/* GOFF0x32 @ graph.h:50 */
+struct node_a {\t/* size=0x10 */
+\tstruct node_b *b_ptr;\t/* loc=0x0 */
+};
+
+/* GOFF0x46 @ graph.h:70 */
+struct node_b {\t/* size=0x10 */
+\tstruct node_a a_value;\t/* loc=0x0 */
+};
+"""
+    for i in reversed(range(depth)):
+        goff = 100 + 10 * i
+        member = "long" if i + 1 == depth else f"struct link_{i + 1}"
+        text += (f"\n/* GOFF0x{goff:x} @ graph.h:{goff} */\n"
+                 f"struct link_{i} {{\t/* size=0x{8 * (depth - i + 1):x} */\n"
+                 f"\tlong value;\t/* loc=0x0 */\n"
+                 f"\t{member} next;\t/* loc=0x8 */\n"
+                 f"}};\n")
+    return text
+
+
+def compiled(test: unittest.TestCase, source, *cflags: str) -> str:
+    # builds 'source' (text, or a dict of file path to text for several
+    # CUs) into an executable that is removed after the test
+    if shutil.which(CC) is None:
+        test.skipTest(f"no C compiler ({CC})")
+    if isinstance(source, str):
+        source = {"fixture.c": source}
+    directory = tempfile.mkdtemp(prefix="d2d-test-")
+    test.addCleanup(shutil.rmtree, directory)
+    paths = []
+    for name, text in source.items():
+        paths.append(os.path.join(directory, name))
+        os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+        with open(paths[-1], "w") as f:
+            f.write(text)
+    binary = os.path.join(directory, "fixture")
+    subprocess.run([CC, "-g", "-gdwarf-4", *cflags, "-o", binary, *paths],
+                   check=True)
+    return binary
+
+
+def parsed(binary: str, **options) -> TypeDG:
+    dg = TypeDG()
+    dg.out = Emitter()
+    for name, value in options.items():
+        setattr(dg, name, value)
+    with dwarf2dtrace.open_elf(binary) as f:
+        dg.parse_file(f)
+    return dg
+
+
+def non_anon(node: Node) -> bool:
+    return node.name is not None
+
+
+class TrackTest(unittest.TestCase):
+    def test_chain_and_cycle_order(self):
+        self.assertEqual(explain_text(chain_and_cycle(4)),
+                         expected_chain_and_cycle(4))
+
+    def test_output_reaches_the_sink(self):
+        dg = chain_and_cycle(4)
+        sink = io.StringIO()
+        dg.out = Emitter(sink)
+        dg.explain({}, non_anon)
+        self.assertEqual(sink.getvalue(), expected_chain_and_cycle(4))
+
+    def test_deep_chain_does_not_recurse(self):
+        depth = 2000 # well past the default recursion limit
+        self.assertEqual(explain_text(chain_and_cycle(depth)),
+                         expected_chain_and_cycle(depth))
+
+
+class NodeStoreTest(unittest.TestCase):
+    def test_compact_graph_renders_the_same(self):
+        dg = chain_and_cycle(50)
+        dg.compact = True
+        dg.offset_to_node = dg.new_store(dg.offset_to_node)
+        self.assertIsInstance(dg.offset_to_node, dwarf2dtrace.NodeStore)
+        before = dg.offset_to_node.nbytes()
+        self.assertEqual(explain_text(dg), expected_chain_and_cycle(50))
+        # the views explain() left cached count too
+        self.assertGreater(dg.offset_to_node.nbytes(), before)
+
+
+class LazyTest(unittest.TestCase):
+    # gcc's DWARF 5 shares decl_file as DW_FORM_implicit_const between
+    # these structs, which the parser skips
+    SOURCE = """
+struct first_holder_struct { long first_value; };
+struct second_holder_struct { long second_value; };
+struct bitfield_holder_struct { unsigned int first_bits:3;
+                                unsigned int second_bits:7; long plain_value; };
+struct first_holder_struct first_var; struct second_holder_struct second_var;
+struct bitfield_holder_struct holder_var;
+int main(void) { return 0; }
+"""
+
+    def test_unparsable_root_is_not_returned(self):
+        binary = compiled(self, self.SOURCE, "-gdwarf-5")
+        name = "struct bitfield_holder_struct"
+        dg = TypeDG()
+        dg.out = Emitter()
+        with dwarf2dtrace.open_elf(binary) as f:
+            roots = dg.parse_lazily(f, [name])
+            text = dg.render({}, non_anon, roots)
+        self.assertEqual(roots, [])
+        self.assertIn(f"/* no type named '{name}' */", dg.out.getvalue())
+        whole = parsed(binary)
+        whole.find_roots([name])
+        self.assertIn(f"/* no type named '{name}' */", whole.out.getvalue())
+        self.assertEqual(text, "")
+
+
+class IncrementalTest(unittest.TestCase):
+    SOURCE = """
+struct inner_type { long inner_value; long other_inner; };
+struct outer_type { struct inner_type inner_member; long outer_value; };
+struct outer_type outer_var; struct inner_type inner_var;
+int main(void) { return 0; }
+"""
+    NAMES = ["struct outer_type", "struct inner_type"]
+
+    def run_since(self, binary, previous, dedup):
+        # what main() does for -t ... [--dedup] --manifest/--since
+        dg = TypeDG()
+        dg.out = Emitter()
+        with dwarf2dtrace.open_elf(binary) as f:
+            if dedup:
+                dg.parse_file(f)
+                dg.dedup()
+                roots = dg.find_roots(self.NAMES)
+            else:
+                roots = dg.parse_lazily(f, self.NAMES)
+            manifest = dg.explain_incremental({}, non_anon, roots, previous)
+        return dg.out.getvalue(), manifest
+
+    def edit_inner(self, dedup):
+        before = compiled(self, self.SOURCE)
+        after = compiled(self, self.SOURCE.replace("long inner_value",
+                                                   "unsigned long inner_value"))
+        _, manifest = self.run_since(before, None, dedup)
+        return self.run_since(after, manifest, dedup)
+
+    def test_member_type_change_is_seen_lazily(self):
+        text, _ = self.edit_inner(dedup=False)
+        self.assertIn(" * changed: struct inner_type", text)
+        self.assertIn("long unsigned int inner_value;", text)
+
+    def test_bad_manifest_is_rejected(self):
+        dg = TypeDG()
+        dg.out = Emitter()
+        good = {"hash": "0", "text": "", "defines": []}
+        for manifest in ([], {"format": 0, "types": {}}, {"format": 1},
+                         {"format": 1, "types": {"struct x": {"hash": 1}}},
+                         {"format": 1, "types": {"struct x": dict(
+                             good, defines=[None])}}):
+            with self.assertRaises(dwarf2dtrace.ParseError, msg=manifest):
+                dg.explain_incremental({}, non_anon, [], manifest)
+        TypeDG.check_manifest({"format": 1, "types": {"struct x": good}})
+
+    def test_dependents_are_emitted_again(self):
+        text, manifest = self.edit_inner(dedup=True)
+        self.assertIn(" * changed: struct inner_type", text)
+        self.assertIn(" * re-emitted: struct outer_type", text)
+        self.assertIn("struct outer_type {", text)
+        self.assertIn("long unsigned int inner_value;", text)
+        for entry in manifest["types"].values():
+            self.assertNotIn("\tlong int inner_value;", entry["text"])
+
+
+class NativeDecoderTest(unittest.TestCase):
+    SOURCE = """
+typedef unsigned long counter_type;
+enum signed_enum { NEGATIVE_VALUE = -3, POSITIVE_VALUE = 70000 };
+struct packed_bits { unsigned int low_bits:3; signed short high_bits:13;
+                     unsigned char byte_value; };
+union number_union { long long_value; double double_value; };
+struct many_forms {
+    const volatile counter_type qualified_counter;
+    struct packed_bits bits_member;
+    union number_union union_member;
+    enum signed_enum enum_member;
+    long matrix_member[3][5];
+    struct many_forms *self_pointer;
+    long (*callback_pointer)(struct many_forms *, const char *);
+    struct { long anonymous_value; } anonymous_member;
+    char flexible_member[];
+};
+struct many_forms *forms_var;
+int main(void) { return 0; }
+"""
+
+    def test_same_nodes_and_log(self):
+        for version in ("-gdwarf-4", "-gdwarf-5"):
+            with self.subTest(version=version):
+                binary = compiled(self, self.SOURCE, version)
+                slow = parsed(binary)
+                fast = parsed(binary, native_decoder=True)
+                self.assertEqual(list(fast.offset_to_node.items()),
+                                 list(slow.offset_to_node.items()))
+                self.assertEqual(fast.out.getvalue(), slow.out.getvalue())
+                self.assertEqual(fast.render({}, non_anon),
+                                 slow.render({}, non_anon))
+                if version == "-gdwarf-4":
+                    # gcc's DWARF 5 members use DW_FORM_implicit_const,
+                    # which both decoders still skip alike
+                    self.assertIn("struct many_forms {",
+                                  fast.render({}, non_anon))
+
+
+class StreamTest(unittest.TestCase):
+    def test_diagnostics_once(self):
+        # 'int' is a DW_FORM_string name the parser skips; main() refers
+        # to it after the CU walk already reported it
+        binary = compiled(self, NativeDecoderTest.SOURCE)
+        dg = TypeDG()
+        dg.out = Emitter()
+        with dwarf2dtrace.open_elf(binary) as f:
+            dg.explain_streaming(f, non_anon)
+        streamed = dg.out.getvalue().splitlines()
+        whole = parsed(binary)
+        ignored = [line for line in streamed if "ignored" in line]
+        self.assertTrue(ignored)
+        self.assertEqual(ignored, [line for line in
+                                   whole.out.getvalue().splitlines()
+                                   if "ignored" in line])
+        self.assertEqual([line for line in streamed if not line in ignored],
+                         whole.render({}, non_anon).splitlines())
+        self.assertEqual(dg.faulted_units, {})
+
+
+class CTFTest(unittest.TestCase):
+    SOURCES = {
+        # alpha.c only sees a declaration, so it comes first
+        "alpha.c": """
+struct forward_decl;
+struct alpha_holder { struct forward_decl *forward_ptr; long alpha_value; };
+enum alpha_state { ALPHA_IDLE, ALPHA_BUSY = 7 };
+typedef struct alpha_holder alpha_holder_t;
+union alpha_union { long union_long; char union_bytes[12]; };
+alpha_holder_t alpha_var; enum alpha_state state_var; union alpha_union u_var;
+int main(void) { return 0; }
+""",
+        "beta.c": """
+struct forward_decl { long forward_value; unsigned int forward_bits:5;
+                      unsigned int more_bits:11; };
+struct forward_decl beta_var;
+"""}
+    KINDS = {"DW_TAG_structure_type": CTFWriter.K_STRUCT,
+             "DW_TAG_union_type": CTFWriter.K_UNION,
+             "DW_TAG_enumeration_type": CTFWriter.K_ENUM}
+
+    # name -> kind, size, {member: bit offset}
+    EXPECTED = {
+        "forward_decl": (CTFWriter.K_STRUCT, 16, {
+            "forward_value": 0, "forward_bits": 64, "more_bits": 69}),
+        "alpha_holder": (CTFWriter.K_STRUCT, 16, {
+            "forward_ptr": 0, "alpha_value": 64}),
+        "alpha_union": (CTFWriter.K_UNION, 16, {
+            "union_long": 0, "union_bytes": 0}),
+        "alpha_state": (CTFWriter.K_ENUM, 4, None),
+    }
+
+    def test_round_trip(self):
+        dg = parsed(compiled(self, self.SOURCES))
+        writer = CTFWriter(dg)
+        writer.add(dg.iter_roots(non_anon))
+        types = read_ctf(writer.getvalue())
+        by_name = {}
+        for t in types.values():
+            if t["kind"] != CTFWriter.K_FORWARD:
+                by_name.setdefault(t["name"], t)
+        defined = {node.name: node for node in dg.offset_to_node.values()
+                   if node.tag in self.KINDS and not node.is_decl}
+        self.assertEqual(sorted(defined), sorted(self.EXPECTED))
+        for name, (kind, size, members) in self.EXPECTED.items():
+            t = by_name[name]
+            node = defined[name]
+            self.assertEqual(t["kind"], self.KINDS[node.tag], name)
+            self.assertEqual((t["kind"], t["size"]), (kind, size), name)
+            self.assertEqual(t["size"], node.byte_size, name)
+            if members is None:
+                continue
+            self.assertEqual({member: offset for member, _, offset
+                              in t["members"]}, members, name)
+        self.assertEqual(by_name["alpha_state"]["enumerators"],
+                         [("ALPHA_IDLE", 0), ("ALPHA_BUSY", 7)])
+        self.assertEqual(types[by_name["alpha_holder_t"]["type"]]["name"],
+                         "alpha_holder")
+
+    def test_bitfield_of_a_typedef(self):
+        # no DW_AT_byte_size on the member; the unit size comes from
+        # unsigned int behind a const typedef
+        dg = make_graph([
+            (1, "DW_TAG_base_type", "unsigned int", dict(byte_size=4)),
+            (2, "DW_TAG_typedef", "flag_bits_t", dict(type_goff=1)),
+            (3, "DW_TAG_const_type", None, dict(type_goff=2)),
+            (10, "DW_TAG_structure_type", "flags_holder",
+             dict(byte_size=8, deps=(11,))),
+            (11, "DW_TAG_member", "high_flags",
+             dict(type_goff=3, data_member_location=4, bit_size=5,
+                  bit_offset=24))])
+        writer = CTFWriter(dg)
+        member = dg.get_node(11)
+        self.assertEqual(writer.member_bit_offset(member, dg.get_node(3)),
+                         32 + 3)
+
+    def test_data_bit_offset(self):
+        # DWARF 4+ bitfields as gcc -gdwarf-5 describes them
+        class Config:
+            little_endian = True
+        class CU:
+            cu_offset = 0
+            class dwarfinfo:
+                config = Config
+        A = dwarf2dtrace.FastAttribute
+        dg = TypeDG()
+        dg.out = Emitter()
+        dg.register_die(dwarf2dtrace.FastDIE(
+            "DW_TAG_member", 0x40, CU,
+            {"DW_AT_name": A("DW_FORM_strp", b"more_bits"),
+             "DW_AT_bit_size": A("DW_FORM_data1", 11),
+             "DW_AT_data_bit_offset": A("DW_FORM_data1", 69)}), [None])
+        member = dg.get_node(0x40)
+        self.assertEqual((member.data_member_location, member.byte_size,
+                          member.bit_size, member.bit_offset), (8, 2, 11, 0))
+        self.assertEqual(CTFWriter(dg).member_bit_offset(member, None), 69)
+
+
+class ShardTest(unittest.TestCase):
+    SOURCES = {"alpha/alpha.c": CTFTest.SOURCES["alpha.c"],
+               "beta/beta.c": CTFTest.SOURCES["beta.c"],
+               "beta/gamma.c": "struct gamma_type { long gamma_value; };\n"
+                               "struct gamma_type gamma_var;\n"}
+
+    def shards(self):
+        dg = parsed(compiled(self, self.SOURCES))
+        directory = tempfile.mkdtemp(prefix="d2d-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        texts = {}
+        for name in dg.explain_shards(directory, non_anon):
+            with open(os.path.join(directory, name + ".h")) as f:
+                texts[name] = f.read()
+        return texts
+
+    def shard_with(self, texts, definition):
+        return [name for name, text in texts.items() if definition in text]
+
+    def test_definition_owns_its_name(self):
+        # alpha.c reaches forward_decl through a declaration first; the
+        # definition in beta/beta.c must still land in beta's header
+        texts = self.shards()
+        self.assertNotIn("nowhere", texts)
+        [beta] = self.shard_with(texts, "struct forward_decl {")
+        self.assertTrue(beta.endswith("_beta"), beta)
+        [alpha] = self.shard_with(texts, "struct alpha_holder {")
+        self.assertTrue(alpha.endswith("_alpha"), alpha)
+
+    def test_files_group_by_directory(self):
+        texts = self.shards()
+        self.assertEqual(self.shard_with(texts, "struct gamma_type {"),
+                         self.shard_with(texts, "struct forward_decl {"))
+        # all.h and one header per directory
+        self.assertEqual(len(texts), 3, sorted(texts))
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="d2d-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def load(self, path):
+        dg = TypeDG()
+        dg.out = Emitter()
+        with dwarf2dtrace.open_elf(path) as f:
+            dg.parse_file(f)
+        return dg
+
+    def test_bad_files_get_an_error_reply(self):
+        server = dwarf2dtrace.TypeServer(self.load, [self.directory])
+        text = os.path.join(self.directory, "passwd")
+        with open(text, "w") as f:
+            f.write("root:x:0:0:root:/root:/bin/sh\n")
+        for request in ({"elf": text, "types": ["struct x"]},
+                        {"elf": self.directory, "types": []},
+                        {"elf": "/etc/passwd", "types": []},
+                        {"types": []}, ["not", "an", "object"],
+                        {"elf": text, "types": "struct x"},
+                        {"elf": text, "types": ["struct x", 1]},
+                        {"elf": 1, "types": []}):
+            reply = server.answer(request)
+            self.assertEqual(list(reply), ["error"], request)
+        self.assertIn("ELFError", server.answer({"elf": text,
+                                                 "types": []})["error"])
+        self.assertIn("not served", server.answer({"elf": "/etc/passwd",
+                                                   "types": []})["error"])
+        binary = compiled(self, LazyTest.SOURCE)
+        server.graph(binary, startup=True)
+        for types in ("struct first_holder_struct", [["struct x"]]):
+            reply = server.answer({"elf": binary, "types": types})
+            self.assertIn("list of strings", reply.get("error", ""), types)
+        reply = server.answer({"elf": binary,
+                               "types": ["struct first_holder_struct"]})
+        self.assertIn("struct first_holder_struct {", reply["header"])
+
+    def reply_with(self, data: bytes) -> str:
+        # a server that reads one request and sends back 'data'
+        path = os.path.join(self.directory, "sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(path)
+        listener.listen(1)
+        def serve_once():
+            conn, _ = listener.accept()
+            with conn:
+                conn.makefile('rb').readline()
+                conn.sendall(data)
+        thread = threading.Thread(target=serve_once)
+        thread.start()
+        try:
+            return dwarf2dtrace.query(path, "prog", ["struct x"])
+        finally:
+            thread.join()
+            os.unlink(path)
+
+    def test_client_rejects_bad_replies(self):
+        for data in (b"", b"{\"head", b"[]\n", b"{}\n"):
+            with self.assertRaises(dwarf2dtrace.ParseError, msg=data):
+                self.reply_with(data)
+        self.assertEqual(self.reply_with(b'{"header": "ok"}\n'), "ok")
+
+
+if __name__ == '__main__':
+    unittest.main()